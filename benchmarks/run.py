@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import contextlib
+import statistics
+from datetime import datetime
+
+from benchmarks import synthetic
+from src import manifest
+
+"""
+Benchmark suite
+
+Times the main load/process/write paths against synthetic inputs at several
+scales and compares each result with the stored baseline, failing if any
+benchmark is slower than the baseline by more than the tolerance. A few
+correctness checks on the optimised paths run first.
+
+    python -m benchmarks.run                      # compare against benchmarks/baseline.json
+    python -m benchmarks.run --scales 1,10 --only companies
+    python -m benchmarks.run --save-baseline      # record a new baseline on this machine
+
+"""
+
+baseline_filepath = "benchmarks/baseline.json"
+
+# original module paths, so each benchmark run can point them at a fresh directory
+original_paths = {}
+
+
+def use_data_root(module, data_root):
+    """
+    Point a dataset module's data_dir (and any paths derived from it), and any cache paths it writes to,
+    at a temporary directory.
+    """
+    if module.__name__ not in original_paths:
+        original_paths[module.__name__] = {name: value for name, value in vars(module).items()
+                                           if isinstance(value, str) and value.startswith(("data/", ".cache/"))}
+
+    for name, value in original_paths[module.__name__].items():
+        setattr(module, name, os.path.join(data_root, value))
+
+
+def bench_land_transactions_process(scale, data_root):
+    import shutil
+    from src import land_transactions
+    use_data_root(land_transactions, data_root)
+
+    corrections_dir = land_transactions.data_dir + "sources/corrections/"
+    shutil.copytree("data/gov.im/land-transactions/sources/corrections/", corrections_dir)
+    os.makedirs(land_transactions.data_dir + "outputs/addressing/", exist_ok=True)
+
+    data = synthetic.land_transactions(scale)
+
+    def run():
+        land_transactions.issues.clear()
+        land_transactions.issue_rows.clear()
+        return land_transactions.process_data(data.copy())
+
+    return run
+
+
+def bench_companies_process(scale, data_root):
+    from src import companies
+    use_data_root(companies, data_root)
+
+    data = synthetic.company_search(scale)
+
+    return lambda: companies.process_data(data.copy())
+
+
+def bench_companies_write(scale, data_root):
+    from src import companies
+    use_data_root(companies, data_root)
+
+    synthetic.write_company_search(companies.data_dir, scale)
+    with open(companies.data_dir + "sources/sources.json") as fp:
+        sources = json.load(fp)
+    processed = companies.process_data(companies.load_data(sources))
+
+    return lambda: companies.write_data(processed)
+
+
+def bench_companies_parse_bs4(scale, data_root):
+    import bs4
+    from src import companies
+
+    pages = synthetic.company_pages(scale)
+
+    def run():
+        # the parsing fetch_company_details did before parse_company_html
+        for html in pages:
+            soup = bs4.BeautifulSoup(html, "html.parser")
+            main = companies.parse_company_page(soup)["main"]
+            if not (main.get("registered_office_address") or main.get("registered_address")
+                    or main.get("place_of_business")):
+                companies.parse_registered_address(soup)
+
+    return run
+
+
+def bench_companies_parse_lxml(scale, data_root):
+    from src import companies
+
+    pages = synthetic.company_pages(scale)
+
+    def run():
+        for html in pages:
+            companies.parse_company_html(html)
+
+    return run
+
+
+def bench_planning_load(scale, data_root):
+    from src import planning_applications
+    use_data_root(planning_applications, data_root)
+
+    sources, defaults = synthetic.write_planning(planning_applications.data_dir, scale)
+
+    return lambda: planning_applications.load_data(sources, defaults, interactive=False)
+
+
+def bench_openstreetmap_process(scale, data_root):
+    from src import openstreetmap
+
+    geojson = synthetic.overpass_geojson(scale)
+    sources = {"overpass": [{"label": "addresses"}]}
+
+    def run():
+        # process_data adds columns to the features' tags, so start from a fresh copy each time
+        data = {"overpass": {"addresses": {"geojson": json.loads(json.dumps(geojson))}}}
+        return openstreetmap.process_data(sources, data)
+
+    return run
+
+
+def bench_postcode_boundaries(scale, data_root):
+    from src import openstreetmap
+    use_data_root(openstreetmap, data_root)
+
+    synthetic.write_overpass_postcodes(openstreetmap.data_dir, scale)
+
+    return lambda: openstreetmap.generate_postcode_boundaries(interactive=False)
+
+
+def bench_footprints_convert(scale, data_root):
+    from src import global_ml_building_footprints
+
+    content = synthetic.footprints(scale)
+    filepath = os.path.join(data_root, "footprints.geojson")
+
+    return lambda: global_ml_building_footprints.convert_footprints(content, filepath, compression="gzip")
+
+
+def bench_startup(args):
+    """
+    Time a fresh interpreter running update.py with a short real stage, i.e. the fixed cost paid by short
+    cron-triggered tasks: interpreter start, importing the stage's module (and only that module's dependencies),
+    scheduling and writing the run report.
+    """
+    def run_startup(scale, data_root):
+        report_filepath = os.path.join(data_root, "run-report.json")
+        return lambda: subprocess.run([sys.executable, "update.py"] + args + ["--report", report_filepath], check=True,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return run_startup
+
+
+def check_md5_hashes():
+    """
+    get_md5_series_from_dataframe must give exactly the hashes of get_md5_from_series applied to each row, which
+    existing land transaction corrections (rows.csv) are matched on. Returns a description of each mismatch.
+    """
+    import numpy as np
+    import pandas as pd
+    from src.helpers import get_md5_from_series, get_md5_series_from_dataframe
+
+    mixed = pd.DataFrame({
+        "text": ["Douglas", "Ramsey", "Port St Mary", "Laxey", "Peel"],
+        "unicode": ["Café", "Ballasalla – Malew", "", "Ny Hoe", "Ëllan"],
+        "missing": ["a", np.nan, None, "d", ""],
+        "int": [1, 2, 3, 4, 5],
+        "float": [1.5, np.nan, 3.0, 1e20, -0.0],
+        "float32": np.array([0.1, 0.2, np.nan, 4.0, 5.5], dtype=np.float32),
+        "nullable": pd.array([1, None, 3, 4, None], dtype="Int64"),
+        "date": pd.to_datetime(["2024-01-01 00:00", None, "2023-12-31 10:30", "2020-02-29 00:00", "1999-01-01 23:59"]),
+        "bool": [True, False, True, False, True]
+    })
+
+    frames = {
+        "land_transactions": synthetic.land_transactions(1, rows=500),
+        "mixed": mixed,
+        "object_and_numbers": mixed[["text", "unicode", "missing", "int", "float"]],
+        "numbers": mixed[["int", "float", "float32"]],
+        "nullable": mixed[["text", "nullable"]],
+        "dates": mixed[["text", "date"]],
+    }
+
+    mismatches = []
+    for name, df in frames.items():
+        expected = df.apply(lambda row: get_md5_from_series(row), axis=1)
+        actual = get_md5_series_from_dataframe(df)
+        if not actual.equals(expected):
+            mismatches.append(f"{name}: {int((actual != expected).sum())} of {len(df)} hashes differ")
+
+    return mismatches
+
+
+# correctness checks run before the benchmarks: name -> function returning a list of failures
+checks = {
+    "helpers.get_md5_series_from_dataframe": check_md5_hashes,
+}
+
+benchmarks = {
+    # reads the stored search results and makes no requests
+    "startup.companies_search_plan": bench_startup(["--companies-search-plan"]),
+    "land_transactions.process_data": bench_land_transactions_process,
+    "companies.process_data": bench_companies_process,
+    "companies.write_data": bench_companies_write,
+    "companies.parse_company_page": bench_companies_parse_bs4,
+    "companies.parse_company_html": bench_companies_parse_lxml,
+    "planning_applications.load_data": bench_planning_load,
+    "openstreetmap.process_data": bench_openstreetmap_process,
+    "openstreetmap.generate_postcode_boundaries": bench_postcode_boundaries,
+    "global_ml_building_footprints.convert_footprints": bench_footprints_convert,
+}
+
+# benchmarks that don't depend on data size, only run once at the smallest scale
+unscaled = ["startup.companies_search_plan"]
+
+
+def run_benchmark(name, scale, repeat):
+    with tempfile.TemporaryDirectory() as data_root:
+        # always run the stage, and keep the manifest out of the real cache
+        manifest.force = True
+        manifest.manifest_filepath = os.path.join(data_root, "manifest.json")
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            func = benchmarks[name](scale, data_root)
+
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def load_baseline():
+    if not os.path.isfile(baseline_filepath):
+        return {}
+
+    with open(baseline_filepath) as fp:
+        return json.load(fp)["results"]
+
+
+def save_baseline(results):
+    with open(baseline_filepath, "w") as fp:
+        json.dump({
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "machine": platform.platform(),
+            "python": platform.python_version(),
+            "results": results
+        }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark load/process/write paths on synthetic data")
+    parser.add_argument("--scales", default="1,10,100", help="Comma separated scale factors (default 1,10,100)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the median is reported")
+    parser.add_argument("--only", default=None, help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="Allowed slowdown against the baseline before failing (default 0.3 = 30%%)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--output", default=None, help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    baseline = load_baseline()
+
+    failed_checks = []
+    for name, check in checks.items():
+        failures = check()
+        print(f"{'check ' + name:<60} {'ok' if not failures else 'FAILED'}", flush=True)
+        failed_checks += [name + " - " + failure for failure in failures]
+
+    if failed_checks:
+        print()
+        print("FAILED:", "; ".join(failed_checks))
+        sys.exit(1)
+
+    results = {}
+    regressions = []
+    unbaselined = []
+    for name in benchmarks:
+        if args.only and args.only not in name:
+            continue
+
+        for scale in (scales[:1] if name in unscaled else scales):
+            key = name + "@" + str(scale) + "x"
+            try:
+                seconds = run_benchmark(name, scale, args.repeat)
+            except ImportError as error:
+                print(f"{key:<60} skipped ({error})")
+                continue
+
+            results[key] = round(seconds, 4)
+
+            line = f"{key:<60} {seconds:>10.3f}s"
+            if key in baseline:
+                ratio = seconds / baseline[key]
+                line += f"  {ratio:>6.2f}x baseline"
+                if ratio > 1 + args.tolerance:
+                    line += "  REGRESSION"
+                    regressions.append(key)
+            else:
+                line += "  no baseline"
+                unbaselined.append(key)
+            print(line, flush=True)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        save_baseline(dict(baseline, **results))
+        print("Baseline saved to", baseline_filepath)
+
+    if regressions:
+        print()
+        print("FAILED:", len(regressions), "benchmark(s) slower than baseline by more than",
+              f"{args.tolerance:.0%}:", ", ".join(regressions))
+
+    # a benchmark with nothing to compare against can't catch a regression, so don't pass quietly
+    if unbaselined and not args.save_baseline:
+        print()
+        print("FAILED:", len(unbaselined), "benchmark(s) have no baseline in", baseline_filepath,
+              "- run with --save-baseline on this machine to record one:", ", ".join(unbaselined))
+
+    if regressions or (unbaselined and not args.save_baseline):
+        sys.exit(1)
@@ -0,0 +1,286 @@
+import os
+import io
+import csv
+import json
+import gzip
+import random
+import pandas as pd
+
+"""
+Synthetic benchmark inputs
+
+Generators for land transactions, company search results, planning files,
+Overpass GeoJSON and building footprints. Sizes are multiplied by the scale
+factor, and each generator is seeded so a given scale always produces the same data.
+
+"""
+
+towns = ["Douglas", "Onchan", "Ramsey", "Peel", "Port Erin", "Port St Mary", "Castletown", "Laxey",
+         "Ballasalla", "Kirk Michael", "Andreas", "Aandreas", "Ramsey Road"]
+localities = ["", "", "", "Governors Hill", "Farmhill", "Willaston", "Ballakilley", "Adjacent To Shop"]
+streets = ["Main Road", "Church Street", "Station Road", "Mill Lane", "Orchard Close", "Queens Promenade",
+           "Victoria Road", "Bray Hill", "Land Part Of Field", "Plot 12", "Rear Of Shop", ""]
+parishes = ["Andreas", "Braddan", "Lezayre", "Malew", "Marown", "Onchan", "Patrick", "Rushen"]
+house_names = ["", "", "", "Rose Cottage", "The Old Mill", "Ballakelly Farm", "Thie Veg"]
+registries = [("1931 Act Company", "C"), ("2006 Act Company", "V"), ("Business Name", "B"),
+              ("Foreign Company", "F"), ("Limited Partnership", "L")]
+statuses = ["Live", "Live", "Live", "Dissolved", "Struck Off", "In Liquidation"]
+words = ["Manx", "Island", "Celtic", "Ellan", "Vannin", "Douglas", "Trading", "Holdings", "Marine",
+         "Property", "Services", "Consulting", "Finance", "Digital", "Laxey", "Sulby", "Snaefell"]
+
+
+def postcode(rng, valid=0.95):
+    if rng.random() > valid:
+        return rng.choice(["", "IM99 1AA", "Isle Of Man", "IM1"])
+    return "IM" + str(rng.randint(1, 9)) + " " + str(rng.randint(1, 9)) + \
+        rng.choice("ABDEFGHJLNPQRSTUWXYZ") + rng.choice("ABDEFGHJLNPQRSTUWXYZ")
+
+
+def land_transactions(scale=1, rows=2000):
+    """
+    Land transactions as published, before corrections (note the Parish_ column).
+    """
+    rng = random.Random(scale)
+
+    records = []
+    for i in range(rows * scale):
+        value = str(rng.randint(50, 2000) * 1000)
+        records.append({
+            "SubUnit_Name": rng.choice(["", "", "", "Flat 1", "Flat 2", "Apartment 3"]),
+            "House_Number": rng.choice(["", str(rng.randint(1, 200))]),
+            "House_Name": rng.choice(house_names),
+            "Street_Name": rng.choice(streets),
+            "Locality": rng.choice(localities),
+            "Town": rng.choice(towns),
+            "Postcode": postcode(rng),
+            "Parish_": rng.choice(parishes),
+            "Market_Value": value,
+            "Consideration": value,
+            "Acquisition_Date": "%02d/%02d/%d" % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(2000, 2025)),
+            "MinCompletionDate": "",
+            "CompletionDate": "%02d/%02d/%d" % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(2000, 2025))
+        })
+
+    return pd.DataFrame(records)
+
+
+def company_name(rng):
+    return " ".join(rng.sample(words, rng.randint(1, 3))) + " " + rng.choice(["Limited", "Ltd", "LLC", "Inc", "PLC"])
+
+
+def company_search(scale=1, rows=5000):
+    """
+    Company name search results, including previous names and gaps in the number sequence.
+    """
+    rng = random.Random(scale)
+    next_number = {suffix: 1 for _, suffix in registries}
+
+    records = []
+    while len(records) < rows * scale:
+        registry_type, suffix = rng.choice(registries)
+
+        # leave some numbers unindexed
+        next_number[suffix] += rng.choice([1, 1, 1, 2, 3])
+        number = str(next_number[suffix]).zfill(6) + suffix
+
+        status = rng.choice(statuses)
+        name = company_name(rng)
+        url = "https://services.gov.im/ded/services/companiesregistry/viewcompany.iom?Id=" + number
+        records.append({
+            "Name": name,
+            "Number": number,
+            "Inc/Reg Date": "%d %s %d" % (rng.randint(1, 28), rng.choice(["Jan", "May", "Sep"]), rng.randint(1950, 2025)),
+            "Status": status,
+            "Registry Type": registry_type,
+            "Name Status": "Current",
+            "URL": url,
+            "Index Date": "2025-01-01"
+        })
+
+        if rng.random() < 0.1:
+            records.append(dict(records[-1], Name=company_name(rng), **{"Name Status": "Previous"}))
+
+    return pd.DataFrame(records)
+
+
+def write_company_search(data_dir, scale=1, terms=("L", "INC", "A", "E")):
+    """
+    Write company search results split across name search files, plus the sources.json listing them.
+    """
+    data = company_search(scale)
+
+    os.makedirs(data_dir + "sources/search/names/", exist_ok=True)
+    os.makedirs(data_dir + "sources/search/numbers/", exist_ok=True)
+    os.makedirs(data_dir + "outputs/", exist_ok=True)
+
+    # overlapping terms, as with the real searches
+    for i, term in enumerate(terms):
+        term_data = data.iloc[i::2] if i else data
+        term_data.to_csv(data_dir + "sources/search/names/" + term + ".csv", index=False, quoting=csv.QUOTE_ALL)
+
+    with open(data_dir + "sources/sources.json", "w") as fp:
+        json.dump({"search": {"names": list(terms)}}, fp)
+
+    return data
+
+
+def write_planning(data_dir, scale=1, weeks=20, years=5, rows=200):
+    """
+    Write weekly and annual planning files plus sources.json/defaults.json to match.
+    """
+    rng = random.Random(scale)
+
+    with open("data/gov.im/planning-applications/sources/defaults.json") as fp:
+        defaults = json.load(fp)
+
+    sources = {record_type: {"annual": {}} for record_type in defaults}
+    sources["planning-applications"]["weekly"] = []
+
+    def address():
+        return str(rng.randint(1, 99)) + " " + rng.choice(streets) + "\n" + rng.choice(towns) + "\n" + postcode(rng)
+
+    for week in range(weeks * scale):
+        pub_date = str(pd.Timestamp("2024-01-05") + pd.Timedelta(weeks=week))[0:10]
+        sources["planning-applications"]["weekly"].append(pub_date)
+
+        year_dir = data_dir + "sources/weekly/" + pub_date[0:4] + "/"
+        os.makedirs(year_dir, exist_ok=True)
+        pd.DataFrame([{
+            "Application Number": "24/%05d/B" % rng.randint(1, 99999),
+            "Details": "Erection of extension\\n" + address().replace("\n", "\\n"),
+            "Local Authority": rng.choice(towns),
+            "Date": pub_date
+        } for _ in range(30)]).to_csv(year_dir + pub_date + "-planning-applications.csv", index=False)
+
+    for record_type in defaults:
+        header_map = defaults[record_type]["annual"]["header_map"]
+        for year in range(2024 - years * scale, 2024):
+            sources[record_type]["annual"][str(year)] = {"url": ""}
+
+            year_dir = data_dir + "sources/annual/" + str(year) + "/"
+            os.makedirs(year_dir, exist_ok=True)
+            pd.DataFrame([{
+                column: address() if name == "Property Address" else "%d/%05d/B" % (year % 100, i)
+                for name, column in header_map.items()
+            } for i in range(rows)]).to_csv(year_dir + record_type + ".csv", index=False, encoding="ISO-8859-1")
+
+    os.makedirs(data_dir + "outputs/addressing/", exist_ok=True)
+    with open(data_dir + "sources/sources.json", "w") as fp:
+        json.dump(sources, fp)
+    with open(data_dir + "sources/defaults.json", "w") as fp:
+        json.dump(defaults, fp)
+
+    return sources, defaults
+
+
+def overpass_geojson(scale=1, features=2000, tag="addr:postcode"):
+    """
+    Overpass GeoJSON as returned by the overpass client, with a mix of nodes and ways.
+    """
+    rng = random.Random(scale)
+
+    items = []
+    for i in range(features * scale):
+        lon = -4.8 + rng.random() * 0.5
+        lat = 54.05 + rng.random() * 0.35
+        tags = {
+            "addr:street": rng.choice(streets),
+            "addr:housenumber": str(rng.randint(1, 200)),
+            "addr:city": rng.choice(towns),
+            tag: postcode(rng)
+        }
+
+        if rng.random() < 0.5:
+            geometry = {"type": "Point", "coordinates": [lon, lat]}
+        else:
+            d = 0.0002
+            geometry = {"type": "LineString",
+                        "coordinates": [[lon, lat], [lon + d, lat], [lon + d, lat + d], [lon, lat + d], [lon, lat]]}
+
+        items.append({
+            "type": "Feature",
+            "id": i,
+            "geometry": geometry,
+            "properties": {"id": i, "type": "node", "tags": tags}
+        })
+
+    return {"type": "FeatureCollection", "features": items}
+
+
+def write_overpass_postcodes(data_dir, scale=1, features=500):
+    os.makedirs(data_dir + "sources/overpass/", exist_ok=True)
+    os.makedirs(data_dir + "sources/corrections/", exist_ok=True)
+    os.makedirs(data_dir + "outputs/postcodes/", exist_ok=True)
+
+    with open(data_dir + "sources/overpass/postcodes.geojson", "w") as fp:
+        json.dump(overpass_geojson(scale, features), fp)
+    with open(data_dir + "sources/overpass/postal_codes.geojson", "w") as fp:
+        json.dump(overpass_geojson(scale + 1000, features // 5, tag="postal_code"), fp)
+
+    pd.DataFrame({"postcode": ["IM99 1AA"]}).to_csv(data_dir + "sources/corrections/non-geographic-postcodes.csv",
+                                                    index=False)
+
+
+def footprints(scale=1, buildings=1000):
+    """
+    Gzipped line-delimited GeoJSON building footprints, as downloaded from the dataset links.
+    """
+    rng = random.Random(scale)
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as fp:
+        for _ in range(buildings * scale):
+            lon = -4.8 + rng.random() * 0.5
+            lat = 54.05 + rng.random() * 0.35
+            d = 0.0001 * rng.randint(1, 3)
+            feature = {
+                "type": "Feature",
+                "properties": {"height": -1.0, "confidence": round(rng.random(), 2)},
+                "geometry": {"type": "Polygon",
+                             "coordinates": [[[lon, lat], [lon + d, lat], [lon + d, lat + d], [lon, lat + d], [lon, lat]]]}
+            }
+            fp.write((json.dumps(feature) + "\n").encode("utf-8"))
+
+    return buffer.getvalue()
+
+
+def company_pages(scale=1, pages=20):
+    """
+    Company details pages, laid out like the registry's: a two column details table with a documents link,
+    then previous names and registered agents tables under their headings. Some pages omit sections.
+    """
+    rng = random.Random(scale)
+
+    html = []
+    for i in range(pages * scale):
+        number = str(i + 1).zfill(6) + rng.choice(registries)[1]
+        address = ", ".join([str(rng.randint(1, 99)) + " " + rng.choice(streets), rng.choice(towns), postcode(rng)])
+        address_label = rng.choice(["Registered Office Address", "Registered Address", "Place of Business"])
+        documents = rng.randint(0, 1500)
+
+        rows = [("Company Name", company_name(rng)), ("Company Number", number), ("Status", rng.choice(statuses)),
+                ("Registry Type", rng.choice(registries)[0]), (address_label, address),
+                ("Incorporation Date", "%02d/%02d/%d" % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(1950, 2025)))]
+        main = "".join("<tr><th scope=\"row\">%s</th><td>%s</td></tr>" % row for row in rows)
+        main += ("<tr><th>Documents</th><td><a href=\"purchasefileanddocumentlist.iom?BusinessEntityId=%d\">"
+                 "%s public documents available</a></td></tr>" % (rng.randint(1, 200000), format(documents, ",")))
+
+        sections = []
+        if rng.random() < 0.4:
+            names = "".join("<tr><td>%s</td><td>Previous</td></tr>" % company_name(rng) for _ in range(rng.randint(1, 4)))
+            sections.append("<h2 id=\"names\">Previous Names</h2><table><thead><tr><th>Name</th><th>Status</th></tr>"
+                            "</thead><tbody>" + names + "</tbody></table>")
+        if rng.random() < 0.8:
+            agents = "".join("<tr><td>%s</td><td>%s</td></tr>" % (company_name(rng), address) for _ in range(rng.randint(1, 2)))
+            sections.append("<h2 id=\"agents\">Registered Agents</h2><table><thead><tr><th>Agent</th><th>Address</th>"
+                            "</tr></thead><tbody>" + agents + "</tbody></table>")
+
+        filler = "".join("<li><a href=\"/page%d\">Link %d</a></li>" % (n, n) for n in range(60))
+        html.append(
+            "<!DOCTYPE html><html><head><title>View Company - %s</title><script>var x = 1;</script></head><body>"
+            "<nav><ul>%s</ul></nav><main><h1>Company Details</h1><table class=\"details\"><tbody>%s</tbody></table>"
+            "%s</main><footer><p>&copy; Isle of Man Government</p></footer></body></html>"
+            % (number, filler, main, "".join(sections))
+        )
+
+    return html
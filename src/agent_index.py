@@ -0,0 +1,265 @@
+import os
+import re
+import json
+from hashlib import sha1, sha256
+from collections import defaultdict
+import pandas as pd
+from src.helpers import log
+from src import name_index
+from src.name_index import normalize
+
+"""
+Registered agent and address index
+
+Which companies share a registered agent, or an address (registered office or
+agent's address), from the agents and registered_address of each company's
+details record. Agent names and addresses are normalised so small differences
+in punctuation, case or spacing don't split them, and each company's links are
+kept with inverted indexes from agent and address to company numbers.
+
+The index remembers how far through the details store it has read, so an
+update only reads the records written since (unless the store has been
+compacted, or is a different file, or the normalisation code has changed, when
+it reads them all again).
+
+    agents = AgentIndex()
+    agents.update(details_store)
+    agents.save()
+    agents.companies_with_agent("Example Corporate Services Limited")
+    agents.tables()  # agents, addresses and company-agents dataframes
+
+"""
+
+index_filepath = ".cache/agent-index.json"
+
+# registered office rows in company-agents have no agent
+registered_role = "registered office"
+agent_role = "agent"
+
+
+def normalize_agent(name):
+    return re.sub(r"\bLIMITED\b", "LTD", normalize(name))
+
+
+def normalize_address(address):
+    return normalize(address)
+
+
+def code_digest():
+    """
+    Hash of the code that normalises agents and addresses, so a change to it rebuilds the index.
+    """
+    h = sha256()
+    for filepath in (__file__, name_index.__file__):
+        with open(filepath, "rb") as fp:
+            h.update(fp.read())
+
+    return h.hexdigest()
+
+
+def entity_id(key):
+    """
+    Short id for a normalised agent or address, stable between runs.
+    """
+    return sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+class AgentIndex:
+    def __init__(self, filepath=None):
+        self.filepath = filepath or index_filepath
+
+        # details store read up to: file, size and when it was last compacted, and the code that read it
+        self.store = {"filepath": None, "size": 0, "compacted": None, "code": None}
+        # number -> {"agents": [[agent key, address key], ...], "address": registered address key, "status": ...}
+        self.companies = {}
+        # normalised key -> name or address as last seen
+        self.agents = {}
+        self.addresses = {}
+
+        self.by_agent = defaultdict(set)
+        self.by_address = defaultdict(set)
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filepath):
+            return
+
+        try:
+            with open(self.filepath, "r", encoding="utf-8") as fp:
+                saved = json.load(fp)
+        except Exception as e:
+            log("    ", "WARNING: Could not read agent index, rebuilding:", e)
+            return
+
+        self.store = saved["store"]
+        self.agents = saved["agents"]
+        self.addresses = saved["addresses"]
+        for number, company in saved["companies"].items():
+            self.companies[number] = company
+            self.add_postings(number)
+
+    def save(self):
+        # drop names and addresses no company links to any more
+        self.agents = {key: name for key, name in self.agents.items() if self.by_agent.get(key)}
+        self.addresses = {key: address for key, address in self.addresses.items() if self.by_address.get(key)}
+
+        os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as fp:
+            json.dump({
+                "store": self.store,
+                "agents": self.agents,
+                "addresses": self.addresses,
+                "companies": self.companies
+            }, fp, ensure_ascii=False)
+        os.replace(tmp_filepath, self.filepath)
+
+    def update(self, details):
+        """
+        Bring the index up to date with a DetailsStore. Returns the number of companies read.
+        """
+        size = details.size()
+        code = code_digest()
+        current = (self.store["filepath"] == details.filepath and self.store["compacted"] == details.compacted
+                   and self.store["size"] <= size and self.store.get("code") == code)
+
+        if current:
+            numbers = details.updated_since(self.store["size"])
+            for number in numbers:
+                self.set_company(number, details[number])
+            log("    ", "Agent index updated with", len(numbers), "changed companies")
+        else:
+            self.clear()
+            numbers = []
+            for number, record in details.items():
+                self.set_company(number, record)
+                numbers.append(number)
+            log("    ", "Agent index rebuilt from", len(numbers), "companies")
+
+        self.store = {"filepath": details.filepath, "size": size, "compacted": details.compacted, "code": code}
+
+        return len(numbers)
+
+    def clear(self):
+        self.companies = {}
+        self.agents = {}
+        self.addresses = {}
+        self.by_agent = defaultdict(set)
+        self.by_address = defaultdict(set)
+
+    def set_company(self, number, record):
+        """
+        Replace a company's links with those in its details record.
+        """
+        self.remove_postings(number)
+
+        links = []
+        for agent in record.get("agents") or []:
+            name = (agent.get("agent") or "").strip()
+            address = (agent.get("address") or "").strip()
+            agent_key = normalize_agent(name)
+            address_key = normalize_address(address)
+            if not agent_key and not address_key:
+                continue
+
+            if agent_key:
+                self.agents[agent_key] = name
+            if address_key:
+                self.addresses[address_key] = address
+            if [agent_key, address_key] not in links:
+                links.append([agent_key, address_key])
+
+        registered_address = (record.get("registered_address") or "").strip()
+        address_key = normalize_address(registered_address)
+        if address_key:
+            self.addresses[address_key] = registered_address
+
+        self.companies[number] = {
+            "agents": links,
+            "address": address_key,
+            "status": (record.get("main") or {}).get("status") or ""
+        }
+        self.add_postings(number)
+
+    def add_postings(self, number):
+        company = self.companies[number]
+        for agent_key, address_key in company["agents"]:
+            if agent_key:
+                self.by_agent[agent_key].add(number)
+            if address_key:
+                self.by_address[address_key].add(number)
+        if company["address"]:
+            self.by_address[company["address"]].add(number)
+
+    def remove_postings(self, number):
+        company = self.companies.pop(number, None)
+        if company is None:
+            return
+
+        for agent_key, address_key in company["agents"]:
+            self.by_agent.get(agent_key, set()).discard(number)
+            self.by_address.get(address_key, set()).discard(number)
+        self.by_address.get(company["address"], set()).discard(number)
+
+    def companies_with_agent(self, name):
+        return sorted(self.by_agent.get(normalize_agent(name), ()))
+
+    def companies_at_address(self, address):
+        """
+        Companies with this registered office, or whose agent is at this address.
+        """
+        return sorted(self.by_address.get(normalize_address(address), ()))
+
+    def tables(self):
+        """
+        Normalised tables, as a dict of output name -> dataframe:
+          agents: Agent ID, Agent, and counts of companies, live companies and addresses per agent
+          addresses: Address ID, Address, and counts of companies, registered offices and agents per address
+          company-agents: Number, Role (agent or registered office), Agent ID and Address ID for each link
+        """
+        links = []
+        for number, company in self.companies.items():
+            for agent_key, address_key in company["agents"]:
+                links.append((number, agent_role, agent_key, address_key, company["status"]))
+            if company["address"]:
+                links.append((number, registered_role, "", company["address"], company["status"]))
+        links = pd.DataFrame(links, columns=["Number", "Role", "Agent", "Address", "Status"])
+
+        by_agent = links[links["Agent"] != ""]
+        agents = by_agent.groupby("Agent").agg(
+            Companies=("Number", "nunique"),
+            Addresses=("Address", lambda addresses: addresses[addresses != ""].nunique())
+        )
+        live = by_agent[by_agent["Status"].str.strip().str.lower() == "live"]
+        agents["Live Companies"] = live.groupby("Agent")["Number"].nunique().reindex(agents.index).fillna(0).astype(int)
+        agents = agents.reset_index()
+        agents.insert(0, "Agent ID", agents["Agent"].map(entity_id))
+        agents["Agent"] = agents["Agent"].map(self.agents)
+        agents = agents[["Agent ID", "Agent", "Companies", "Live Companies", "Addresses"]]
+
+        by_address = links[links["Address"] != ""]
+        addresses = by_address.groupby("Address").agg(
+            Companies=("Number", "nunique"),
+            Agents=("Agent", lambda agent_keys: agent_keys[agent_keys != ""].nunique())
+        )
+        registered = by_address[by_address["Role"] == registered_role]
+        addresses["Registered Offices"] = registered.groupby("Address")["Number"].nunique() \
+            .reindex(addresses.index).fillna(0).astype(int)
+        addresses = addresses.reset_index()
+        addresses.insert(0, "Address ID", addresses["Address"].map(entity_id))
+        addresses["Address"] = addresses["Address"].map(self.addresses)
+        addresses = addresses[["Address ID", "Address", "Companies", "Registered Offices", "Agents"]]
+
+        company_agents = pd.DataFrame({
+            "Number": links["Number"],
+            "Role": links["Role"],
+            "Agent ID": links["Agent"].map(lambda key: entity_id(key) if key else ""),
+            "Address ID": links["Address"].map(lambda key: entity_id(key) if key else "")
+        })
+
+        return {
+            "agents": agents.sort_values(by=["Companies", "Agent ID"], ascending=[False, True]),
+            "addresses": addresses.sort_values(by=["Companies", "Address ID"], ascending=[False, True]),
+            "company-agents": company_agents.sort_values(by=["Number", "Role", "Agent ID", "Address ID"])
+        }
@@ -1,14 +1,22 @@
+import io
 import os
-import time
 from datetime import datetime
-import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import urllib.parse
+import numpy as np
 import pandas as pd
 import bs4
+import lxml.html
 import csv
 import json
 import re
-from src.helpers import get_url, log, prompt
+import threading
+from src.helpers import get_url, instrument, log, pause, prompt, set_rate_limit, write_parquet
+from src.manifest import inputs_digest, stage_is_current, record_stage
+from src.details_store import DetailsStore, migrate_json
+from src import agent_index, details_store, name_index, page_archive, search_planner
+from src.agent_index import AgentIndex
+from src.page_archive import archive_page, latest_pages, read_page
 
 """
 Companies Registry data processing
@@ -19,12 +27,16 @@ data_dir = "data/gov.im/companies/"
 registry_url = "https://services.gov.im/ded/services/companiesregistry/"
 search_page = "companysearch.iom?"
 
-details_filepath = data_dir + "sources/details/details.json"
-unindexed_filepath = data_dir + "outputs/company-numbers-unindexed.csv"
+details_filepath = data_dir + "sources/details/details.jsonl"
 not_found_filepath = data_dir + "sources/search/numbers/not-found.csv"
 
+# indexes rebuilt with the outputs, kept in the cache rather than the data directory
+name_index_dir = name_index.index_dir
+agent_index_filepath = agent_index.index_filepath
 
-def companies(latest=True, unindexed=False, details=False, interactive=True):
+
+def companies(latest=True, unindexed=False, details=False, full_list=False, detail_columns=(), search_workers=4,
+              search_rate=0.2, search_min_yield=0.0, details_rate=0.5, details_workers=4, interactive=True):
     log("# Companies Registry - Isle of Man Government")
 
     with open(data_dir + "sources/sources.json") as fp:
@@ -33,85 +45,90 @@ def companies(latest=True, unindexed=False, details=False, interactive=True):
     with open(data_dir + "sources/status.json") as fp:
         status = json.load(fp)
 
-    # NOTE: current architecture requires write at each stage, ready for next
-    # TODO: improve to write only once
-    written = False
+    # search results are read once, after the latest search, and kept in memory; the number search adds its
+    # rows to them, and outputs are derived in memory for each step that needs them and written once at the end
+    search = None
+    processed = None
 
     # search for latest companies by name
     if latest or interactive:
-        companies_latest(sources, status, interactive)
-
-        # load data and write outputs
-        load_process_write_data(sources)
-        written = True
+        companies_latest(sources, status, interactive, search_workers, search_rate, search_min_yield)
 
     if unindexed:
-        companies_unindexed(interactive)
+        search = read_search_files(sources)
+        processed = process_data(combine_search_data(search), full_list)
 
-        # load data and write outputs
-        load_process_write_data(sources)
-        written = True
+        new_rows = companies_unindexed(processed["company-numbers-unindexed"], interactive, search_workers, search_rate)
+        if not new_rows.empty:
+            search["numbers"] = pd.concat([search["numbers"], new_rows])
+            processed = None
 
     if details:
-        update_company_details(targets=['live'], interactive=interactive)
+        if search is None:
+            search = read_search_files(sources)
+        if processed is None:
+            processed = process_data(combine_search_data(search), full_list)
 
-        # load data and write outputs
-        load_process_write_data(sources)
-        written = True
+        update_company_details(targets=['live'], rate=details_rate, workers=details_workers, interactive=interactive,
+                               outputs=processed)
 
-    if not written:
-        # load data and write outputs
-        load_process_write_data(sources)
+    # load data (unless already in memory) and write outputs
+    load_process_write_data(sources, full_list, detail_columns, search=search, processed=processed)
 
 
-def companies_latest(sources, status, interactive=True):
+def companies_latest(sources, status, interactive=True, workers=4, rate=0.2, min_yield=0.0):
     log(" - Get latest companies")
 
     if interactive:
         update_text = prompt("Download latest company registry details? (y/N) ")
         if update_text == "y":
-            update_companies_list(sources, status)
+            update_companies_list(sources, status, workers, rate, min_yield)
     else:
-        update_companies_list(sources, status)
+        update_companies_list(sources, status, workers, rate, min_yield)
 
 
-def companies_unindexed(interactive=True):
-    if os.path.isfile(unindexed_filepath):
-        unindexed = pd.read_csv(unindexed_filepath)
-        log("    ", len(unindexed["Number"]), "unindexed company numbers detected")
+def companies_unindexed(unindexed, interactive=True, workers=4, rate=0.2):
+    """
+    Search by number for a batch of the unindexed company numbers, returning the rows found.
+    """
+    log("    ", len(unindexed["Number"]), "unindexed company numbers detected")
 
-        # exclude companies previously not found when searching by number
-        if os.path.isfile(not_found_filepath):
-            not_found = pd.read_csv(not_found_filepath)
-            log("    ", len(not_found["Number"]), "company numbers previously not found in index")
+    # exclude companies previously not found when searching by number
+    if os.path.isfile(not_found_filepath):
+        not_found = pd.read_csv(not_found_filepath)
+        log("    ", len(not_found["Number"]), "company numbers previously not found in index")
 
-            unindexed = unindexed[~unindexed["Number"].isin(not_found["Number"])]
+        unindexed = unindexed[~unindexed["Number"].isin(not_found["Number"])]
 
-        batch_count = 0
-        if len(unindexed["Number"]):
-            if interactive:
-                batch_text = prompt("Download batch of [x] from ~" + str(len(unindexed["Number"])) + " unindexed companies? (default 0) ")
-                if batch_text:
-                    batch_count = int(batch_text)
-            else:
-                batch_count = len(unindexed["Number"])
+    batch_count = 0
+    if len(unindexed["Number"]):
+        if interactive:
+            batch_text = prompt("Download batch of [x] from ~" + str(len(unindexed["Number"])) + " unindexed companies? (default 0) ")
+            if batch_text:
+                batch_count = int(batch_text)
+        else:
+            batch_count = len(unindexed["Number"])
+
+    if batch_count > 0:
+        log("    ", "Updating ", batch_count, "unindexed companies")
+        unindexed_numbers = unindexed["Number"][:batch_count]
+        return update_companies_list_by_number(unindexed_numbers, workers, rate)
 
-        if batch_count > 0:
-            log("    ", "Updating ", batch_count, "unindexed companies")
-            unindexed_numbers = unindexed["Number"][:batch_count]
-            update_companies_list_by_number(unindexed_numbers)
+    return pd.DataFrame()
 
 
+@instrument
 def load_data(sources):
     log(" - Loading Companies")
 
     # load data into dataframes
-    data = read_search_files(sources)
+    data = combine_search_data(read_search_files(sources))
 
     return data
 
 
-def process_data(data):
+@instrument
+def process_data(data, full_list=False):
     log(" - Processing Companies")
 
     companies_live = data[data["Status"].isin(["Live"])]
@@ -134,57 +151,77 @@ def process_data(data):
     registries = registries.rename(columns={"Numeric": "Latest Number"})
     registries = registries.sort_values(by=["Registry Type"])
 
-    full_list = pd.DataFrame(columns=["Number"])
-    for index, row in registries.iterrows():
-        registry_list = pd.DataFrame(company_list(row["Latest Number"], row['Suffix']))
-        registry_list = registry_list.rename(columns={0: "Number"})
-        full_list = pd.concat([full_list, registry_list], ignore_index=True)
+    # each registry's numbers run from 1 to its latest number, so the gaps are that range less the numbers indexed
+    # for its suffix (only well formed numbers, as those are the ones that can match a generated number)
+    indexed = data[data["Number"].str.len() == 7]
+    indexed_by_suffix = {suffix: group["Numeric"].to_numpy() for suffix, group in indexed.groupby("Suffix")}
 
-    full_list = full_list.sort_values(by=["Number"])
+    gaps = []
+    for latest, suffix in zip(registries["Latest Number"], registries["Suffix"]):
+        numbers = np.arange(1, int(latest) + 1)
+        gaps.append((np.setdiff1d(numbers, indexed_by_suffix.get(suffix, [])), suffix))
 
-    unindexed = full_list[~full_list.Number.isin(data["Number"])]
-    unindexed = unindexed.sort_values(by=["Number"])
+    unindexed = format_company_numbers(gaps)
 
     data = {
         "companies-live": companies_live,
         "companies-non-live": companies_non_live,
         "old-names": old_names,
         "registries": registries,
-        "company-numbers-full": full_list,
         "company-numbers-unindexed": unindexed
     }
 
+    # changes since the outputs were last written, if there are any to compare with
+    previous = read_previous_companies()
+    if previous is not None:
+        data["company-changes"] = company_changes(pd.concat([companies_live, companies_non_live]), previous)
+
+    # the full list is every number up to each registry's latest, so only expand it when asked for
+    if full_list:
+        data["company-numbers-full"] = company_numbers(registries)
+
     return data
 
 
-def write_data(data):
+@instrument
+def write_data(data, detail_columns=()):
     """
     Writes CSV outputs. For companies-live and companies-non-live, attempt to include
-    Registered Address by reading the details.json created by update_company_details.
+    Registered Address by reading the details store created by update_company_details,
+    and write the agents, addresses and company-agents tables from the agent index.
+
+    detail_columns: names of any extra_detail_columns to add to those two outputs as well
     """
     log(" - Writing Companies")
 
-    # load details mapping (Number -> details)
     details = load_details_file()
 
-    # If companies-live/non-live present, augment with Registered Address column
+    # agent and address tables, from the details changed since they were last built
+    agents = AgentIndex(agent_index_filepath)
+    agents.update(details)
+    agents.save()
+    data = dict(data, **agents.tables())
+
+    # details table indexed by Number, read once for both outputs
+    details = details_table(details, detail_columns)
+
+    # If companies-live/non-live present, augment with Registered Address (and any extra) columns
     for record_type in data:
         df = data[record_type]
 
-        # Only attempt to add registered address for the two company outputs
+        # the change feed is kept per run rather than replaced
+        if record_type == "company-changes":
+            write_changes(df)
+            continue
+
+        # Only attempt to add details for the two company outputs
         if record_type in ("companies-live", "companies-non-live"):
             if "Number" in df.columns:
-                # build a list mapping Number -> registered_address if present
-                reg_addrs = []
-                for _, row in df.iterrows():
-                    number = str(row.get("Number", "")).strip()
-                    addr = ""
-                    if number in details and details[number].get("registered_address"):
-                        addr = details[number].get("registered_address", "")
-                    reg_addrs.append(addr)
-                # add/replace Registered Address column
+                numbers = df["Number"].astype(str).str.strip()
+                # add/replace detail columns
                 df = df.copy()
-                df["Registered Address"] = reg_addrs
+                for column in details.columns:
+                    df[column] = numbers.map(details[column]).fillna("")
             else:
                 log("    ", "WARNING: No Number column in", record_type, "- cannot add Registered Address")
 
@@ -192,90 +229,504 @@ def write_data(data):
         filename = record_type + ".csv"
         filepath = data_dir + "outputs/" + filename
         df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+        write_parquet(df, filepath)
         log("    ", len(df), "rows written to", filename)
 
+    # name search index over current and previous names
+    name_outputs = ("companies-live", "companies-non-live", "old-names")
+    if all(output in data for output in name_outputs):
+        name_index.build_index([data[output] for output in name_outputs], name_index_dir)
 
-def load_process_write_data(sources):
-    data = load_data(sources)
-    data = process_data(data)
-    write_data(data)
 
+change_key = ["Number", "Registry Type"]
+change_values = ["Name", "Status"]
 
-def company_list(count, suffix):
-    company_numbers = list(range(1, count+1))
 
-    formatted = []
-    for company in company_numbers:
-        formatted.append(str(company).zfill(6) + suffix)
+def read_previous_companies():
+    """
+    Current companies (live and non-live) from the outputs written by the last run, or None if there aren't any.
+    """
+    filepaths = [data_dir + "outputs/" + output + ".csv" for output in ("companies-live", "companies-non-live")]
+    if not all(os.path.isfile(filepath) for filepath in filepaths):
+        return None
 
-    return formatted
+    return pd.concat([pd.read_csv(filepath, usecols=change_key + change_values, dtype=str, keep_default_na=False)
+                      for filepath in filepaths])
 
 
-def update_companies_list(sources, status):
-    for term in sources["search"]["names"]:
+def company_changes(current, previous):
+    """
+    Companies added, removed, or with a changed name or status, between two sets of current companies.
+    Rows are matched on a hash of Number + Registry Type, and compared on a hash of Name + Status.
+    Returns a dataframe with a Change column (added, removed, name, status, or name, status), the company's
+    current Number, Registry Type, Name and Status, and its Previous Name and Previous Status.
+    """
+    frames = []
+    for df in (current, previous):
+        # a company that moved between live and non-live can be in both, the non-live row is the later one
+        df = df[change_key + change_values].fillna("").astype(str)
+        df = df.drop_duplicates(subset=change_key, keep="last").reset_index(drop=True)
+        frames.append((df, pd.util.hash_pandas_object(df[change_key], index=False).to_numpy(),
+                       pd.util.hash_pandas_object(df[change_values], index=False).to_numpy()))
 
-        page = 1
-        skip_rows = 0
-        if term in status["search"]["names"]:
-            term_status = status["search"]["names"][term]["latest"]
+    (current, current_keys, current_values), (previous, previous_keys, previous_values) = frames
+
+    # hash join of the current companies onto the previous ones, -1 where not previously seen
+    matched = pd.Index(previous_keys).get_indexer(current_keys)
+    found = matched >= 0
+
+    added = current[~found]
+    removed = previous[~np.isin(previous_keys, current_keys)]
+
+    # only compare names and statuses of the rows whose hashes differ
+    differs = np.flatnonzero(found)[current_values[found] != previous_values[matched[found]]]
+    changed = current.iloc[differs].reset_index(drop=True)
+    before = previous.iloc[matched[differs]].reset_index(drop=True)
+
+    name_changed = changed["Name"] != before["Name"]
+    status_changed = changed["Status"] != before["Status"]
+    changed["Change"] = np.where(name_changed & status_changed, "name, status",
+                                 np.where(name_changed, "name", "status"))
+    changed["Previous Name"] = before["Name"]
+    changed["Previous Status"] = before["Status"]
+
+    added = added.assign(**{"Change": "added", "Previous Name": "", "Previous Status": ""})
+    removed = removed.assign(**{"Change": "removed", "Previous Name": removed["Name"],
+                                "Previous Status": removed["Status"], "Name": "", "Status": ""})
+
+    columns = ["Change"] + change_key + change_values + ["Previous Name", "Previous Status"]
+    changes = pd.concat([added, removed, changed])[columns]
+
+    return changes.sort_values(by=["Change", "Number", "Registry Type"], kind="stable").reset_index(drop=True)
+
+
+def write_changes(changes):
+    """
+    Write the change feed for this run to outputs/changes/, named by the time of the run.
+    """
+    counts = changes["Change"].value_counts()
+    log("    ", "Changes since last run:", ", ".join(f"{count} {change}" for change, count in counts.items()) or "none")
+    if changes.empty:
+        return
+
+    filename = "changes/changes-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".csv"
+    os.makedirs(data_dir + "outputs/changes/", exist_ok=True)
+    changes.to_csv(data_dir + "outputs/" + filename, index=False, quoting=csv.QUOTE_ALL)
+    log("    ", len(changes), "rows written to", filename)
+
+
+# extra columns that can be added to the company outputs from the details store: name -> (column, value from record)
+extra_detail_columns = {
+    "agent": ("Agent", lambda record: record.get("agent") or ""),
+    "document_count": ("Document Count", lambda record: (record.get("documents") or {}).get("count", "")),
+    "previous_names": ("Previous Names",
+                       lambda record: "; ".join(name.get("name", "") for name in record.get("previous_names") or [])),
+}
+
+
+def details_table(details, detail_columns=()):
+    """
+    Registered Address, plus any extra_detail_columns named, for every company in the details store,
+    as a dataframe indexed by Number.
+    """
+    columns = [("Registered Address", lambda record: record.get("registered_address") or "")]
+    columns += [extra_detail_columns[name] for name in detail_columns]
+
+    numbers = []
+    rows = []
+    for number, record in details.items():
+        numbers.append(number)
+        rows.append([value(record) for _, value in columns])
+    details.close()
+
+    return pd.DataFrame(rows, index=pd.Index(numbers, name="Number"), columns=[column for column, _ in columns],
+                        dtype=object)
+
+
+def load_process_write_data(sources, full_list=False, detail_columns=(), search=None, processed=None):
+    """
+    search/processed: search results already read by read_search_files, and outputs already derived from them,
+    to use instead of reading and processing the search files again
+    """
+    # skip if search results, details, options and code are unchanged since outputs were last written
+    digest = inputs_digest(input_files(sources) + [__file__, agent_index.__file__, name_index.__file__,
+                                                   details_store.__file__],
+                           config={"full_list": full_list, "detail_columns": sorted(detail_columns)})
+    if stage_is_current("companies", digest, outputs=output_files(full_list)):
+        log("    ", "Sources unchanged since last run, skipping processing")
+        return
+
+    data = processed
+    if data is None:
+        data = combine_search_data(search) if search is not None else load_data(sources)
+        data = process_data(data, full_list)
+    write_data(data, detail_columns)
+
+    record_stage("companies", digest)
+
+
+def input_files(sources):
+    inputs = [search_filepath(term) for term in sources["search"]["names"]]
+    inputs += [
+        data_dir + "sources/search/numbers/numbers.csv",
+        data_dir + "sources/sources.json",
+        details_filepath
+    ]
+
+    return inputs
+
+
+def output_files(full_list=False):
+    outputs = ["companies-live", "companies-non-live", "old-names", "registries", "company-numbers-unindexed",
+               "agents", "addresses", "company-agents"]
+    if full_list:
+        outputs.append("company-numbers-full")
+
+    # the indexes are written with the outputs, so if one's missing they need writing again
+    return [data_dir + "outputs/" + output + ".csv" for output in outputs] + \
+        [name_index_dir + "meta.json", agent_index_filepath]
+
+
+def company_numbers(registries):
+    """
+    Every company number from 1 to each registry's latest number.
+    """
+    return format_company_numbers([(np.arange(1, int(latest) + 1), suffix)
+                                   for latest, suffix in zip(registries["Latest Number"], registries["Suffix"])])
+
+
+def format_company_numbers(parts):
+    """
+    parts: list of (array of numeric ids, suffix)
+    Returns a Number dataframe of zero padded numbers with their suffix, sorted by number then suffix.
+    """
+    numbers = np.concatenate([numeric for numeric, _ in parts] + [np.array([], dtype=int)])
+    suffixes = np.concatenate([np.full(len(numeric), suffix, dtype=object) for numeric, suffix in parts]
+                              + [np.array([], dtype=object)])
+
+    order = np.lexsort((suffixes, numbers))
+    formatted = pd.Series(numbers[order]).astype(str).str.zfill(6) + pd.Series(suffixes[order], dtype=object)
+
+    return pd.DataFrame({"Number": formatted})
+
+
+@instrument
+def update_companies_list(sources, status, workers=4, rate=0.2, min_yield=0.0):
+    """
+    Crawl the name search terms concurrently, up to `workers` at a time, with requests to the registry limited
+    to `rate` per second across all of them.
+
+    min_yield: skip terms estimated (see search_planner) to find fewer new companies than this per request
+    """
+    terms = sources["search"]["names"]
+    if min_yield:
+        plan = search_planner.plan_terms(search_planner.load_term_numbers(search_filepaths(terms)))
+        search_planner.log_plan(plan, min_yield)
+
+        # most productive terms first, and any without stored results
+        skipped = search_planner.skipped_terms(plan, min_yield)
+        terms = [step["term"] for step in plan if step["term"] not in skipped] + \
+                [term for term in terms if term not in [step["term"] for step in plan]]
+
+    set_rate_limit(urllib.parse.urlsplit(registry_url).netloc, rate)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(update_companies_list_for_term, term, SearchCheckpoint(status, term)): term
+                   for term in terms}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                # let the other terms finish, then report the failure
+                log("    ", "ERROR: Search for", futures[future], "failed:", repr(error))
+                errors.append(error)
+
+    if errors:
+        raise errors[0]
 
-            if term_status["rows"] == 30:
-                # start on next page after full page retrieved
-                page = term_status["page"] + 1
-            else:
-                # start on final page again
-                # TODO: skip the rows we've already seen
-                #       ... may want to check contents as well, to ensure sort order is the same
-                page = term_status["page"]
-                skip_rows = term_status["rows"]
 
+def update_companies_list_for_term(term, checkpoint):
+    page, last_row = checkpoint.resume()
+
+    try:
         while True:
             data = get_search_page(term, page=page)
 
             if not data.empty:
-                # TODO: fix stats recording if skipping rows
-                #if skip_rows:
-                #    log("    ", "Skipping first", skip_rows, "already retrieved")
-                #    data = data.iloc[1:skip_rows, :]
-                #    skip_rows = 0
+                new_data = data
+                if last_row is not None:
+                    # the page we stopped on last time, only keep rows after the last one retrieved
+                    new_data = rows_after(data, last_row)
+                    log("    ", "Skipping", len(data) - len(new_data), "rows already retrieved for", term)
+                    last_row = None
 
-                write_search_page(term, page, data)
+                checkpoint.add_page(page, data, new_data)
 
                 if len(data) == 30:
                     page = page + 1
                 else:
-                    log("    ", "End of list")
+                    log("    ", "End of list for", term)
                     break
 
             else:
-                log("    ", "No more data")
+                log("    ", "No more data for", term)
                 break
 
-            sleep = random.randint(5, 10)
-            log("    ", "... pausing for", sleep, "seconds ...")
-            time.sleep(sleep)
+    finally:
+        # keep whatever was retrieved, even if the crawl stopped part way
+        checkpoint.flush()
 
 
-def update_companies_list_by_number(numbers):
-    for number in numbers:
+def rows_after(data, last_row):
+    """
+    Rows of a search page after the one matching last_row (ignoring Index Date and URL, which change between
+    searches), or the whole page if it isn't found, e.g. if the results have changed order.
+    """
+    keys = [key for key in ("Name", "Number", "Registry Type", "Name Status") if key in last_row]
 
-        try:
-            data = get_search_page(number, search_by=1)
+    matches = (data[keys] == pd.Series({key: str(last_row[key]) for key in keys})).all(axis=1).to_numpy()
+    if not matches.any():
+        log("    ", "WARNING: Last retrieved row not found on page, keeping all rows")
+        return data
+
+    return data.iloc[np.flatnonzero(matches)[-1] + 1:]
 
-            if not data.empty:
-                write_search_by_number_page(data)
 
+class SearchCheckpoint:
+    """
+    Name search progress for a term, written in batches. Pages are buffered and every `batch_pages` pages the
+    new rows are appended to the term's CSV and then its status is written to status.json, replaced atomically.
+    The status records the CSV's size so that rows appended after the last status write (i.e. by a run that
+    stopped between the two) can be dropped on resume, once rows_appended_after has checked that's all they are.
+
+    Terms are crawled concurrently, each with its own checkpoint, so a term's status only reaches the shared
+    status dict once its rows are in its CSV.
+    """
+    status_lock = threading.Lock()
+
+    def __init__(self, status, term, batch_pages=10):
+        self.status = status
+        self.term = term
+        self.batch_pages = batch_pages
+        self.pending = []
+        self.pending_pages = 0
+        self.latest = None
+
+    def resume(self):
+        """
+        Page to continue from, and the last row retrieved if that page was incomplete.
+        """
+        with self.status_lock:
+            if self.term not in self.status["search"]["names"]:
+                return 1, None
+            term_status = dict(self.status["search"]["names"][self.term]["latest"])
+
+        filepath = search_filepath(self.term)
+        if "bytes" in term_status and os.path.isfile(filepath) and os.path.getsize(filepath) > term_status["bytes"]:
+            appended = rows_appended_after(filepath, term_status)
+            if appended is None:
+                # not what an interrupted run leaves (e.g. edited, merged or line endings converted), so keep it,
+                # rows retrieved again are dropped as duplicates when processed
+                log("    ", "WARNING:", filepath, "has changed since the last checkpoint, not removing rows")
             else:
-                write_search_by_number_not_found(number)
-                log("    ", "Company", number, "not found")
+                log("    ", "Removing", appended, "rows for", self.term, "appended after the last checkpoint")
+                os.truncate(filepath, term_status["bytes"])
+
+        if term_status["rows"] == 30:
+            # start on next page after full page retrieved
+            return term_status["page"] + 1, None
+
+        # start on final page again, skipping the rows already retrieved
+        return term_status["page"], term_status["last_row"]
+
+    def add_page(self, page, data, new_data):
+        """
+        data: the full page, new_data: the rows from it not already retrieved
+        """
+        if len(new_data):
+            self.pending.append(new_data)
+
+        records = data.to_dict("records")
+        self.latest = {
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "page": page,
+            "rows": len(records),
+            "last_row": records.pop()
+        }
+
+        self.pending_pages += 1
+        if self.pending_pages >= self.batch_pages:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_pages:
+            return
+
+        filepath = search_filepath(self.term)
+        if self.pending:
+            add_header = not os.path.isfile(filepath)
+            pd.concat(self.pending).to_csv(filepath, mode="a", index=False, header=add_header, quoting=csv.QUOTE_ALL)
+
+        if os.path.isfile(filepath):
+            self.latest["bytes"] = os.path.getsize(filepath)
+
+        with self.status_lock:
+            self.status["search"]["names"].setdefault(self.term, {})["latest"] = self.latest
+
+            # replace status.json in one step, so it's never left part written
+            status_filepath = data_dir + "sources/status.json"
+            with open(status_filepath + ".tmp", "w") as fp:
+                fp.write(json.dumps(self.status, indent=2))
+            os.replace(status_filepath + ".tmp", status_filepath)
+
+        self.pending = []
+        self.pending_pages = 0
+
+
+def rows_appended_after(filepath, term_status):
+    """
+    Number of rows in a search CSV past the size recorded at its last checkpoint, if those bytes are whole rows
+    retrieved after that checkpoint, as a run stopped between appending rows and writing its status leaves them.
+    None if they aren't, in which case the file has been changed some other way and shouldn't be cut.
+    """
+    offset = term_status["bytes"]
+    if offset < 1:
+        return None
+
+    with open(filepath, "rb") as fp:
+        header = fp.readline()
+        fp.seek(offset - 1)
+        tail = fp.read()
+
+    # the checkpoint must fall on a row boundary and the last row must be complete
+    if not tail.startswith(b"\n") or not tail.endswith(b"\n"):
+        return None
+
+    try:
+        columns = next(csv.reader([header.decode("utf-8")]))
+        rows = list(csv.reader(io.StringIO(tail[1:].decode("utf-8"))))
+    except (UnicodeDecodeError, csv.Error, StopIteration):
+        return None
+
+    if any(len(row) != len(columns) for row in rows):
+        return None
 
-            sleep = random.randint(1, 5)
-            log("    ", "... pausing for", sleep, "seconds ...")
-            time.sleep(sleep)
+    rows = pd.DataFrame(rows, columns=columns, dtype=str)
+    last_row = term_status.get("last_row") or {}
+    keys = [key for key in ("Name", "Number", "Registry Type", "Name Status") if key in last_row and key in columns]
+    if keys and (rows[keys] == pd.Series({key: str(last_row[key]) for key in keys})).all(axis=1).any():
+        return None
 
+    # rows appended after the checkpoint were retrieved on or after its date
+    checkpoint_date = str(term_status.get("updated", ""))[:10]
+    if "Index Date" in columns and (rows["Index Date"] < checkpoint_date).any():
+        return None
+
+    return len(rows)
+
+
+def search_filepath(term):
+    return data_dir + "sources/search/names/" + term + ".csv"
+
+
+def search_filepaths(terms):
+    return {term: search_filepath(term) for term in terms}
+
+
+def companies_search_plan(min_yield=0.0):
+    """
+    Public function invoked by update.py
+
+    Report the estimated requests and new companies per name search term, without making any requests.
+    """
+    log("# Companies Registry - name search coverage")
+
+    with open(data_dir + "sources/sources.json") as fp:
+        sources = json.load(fp)
+
+    term_numbers = search_planner.load_term_numbers(search_filepaths(sources["search"]["names"]))
+    search_planner.log_plan(search_planner.plan_terms(term_numbers), min_yield)
+
+
+@instrument
+def update_companies_list_by_number(numbers, workers=4, rate=0.2, retries=3, batch_size=50):
+    """
+    Search for each company number, up to `workers` at a time with requests limited to `rate` per second,
+    returning the rows found as they read back from numbers.csv.
+
+    Each number is retried up to `retries` times; numbers that still fail are logged and left for the next run.
+    Results are written every `batch_size` numbers, so an interrupted run keeps most of what it retrieved.
+    """
+    # numbers already searched for without a result, kept in memory rather than re-read
+    not_found = set(pd.read_csv(not_found_filepath, dtype=str)["Number"]) if os.path.isfile(not_found_filepath) else set()
+    numbers = [number for number in numbers if number not in not_found]
+
+    set_rate_limit(urllib.parse.urlsplit(registry_url).netloc, rate)
+
+    found = []
+    pending_found = []
+    pending_not_found = []
+    failed = 0
+
+    def flush():
+        if pending_found:
+            write_search_by_number_page(pd.concat(pending_found, ignore_index=True))
+        if pending_not_found:
+            write_search_by_number_not_found(pending_not_found)
+        pending_found.clear()
+        pending_not_found.clear()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(search_by_number, number, retries): number for number in numbers}
+
+            for completed, future in enumerate(as_completed(futures), start=1):
+                number = futures[future]
+                try:
+                    data = future.result()
+                except Exception as error:
+                    log("    ", "ERROR: Search for company", number, "failed:", repr(error))
+                    failed += 1
+                    continue
+
+                if not data.empty:
+                    pending_found.append(data)
+                    found.append(data)
+                else:
+                    pending_not_found.append(number)
+                    not_found.add(number)
+                    log("    ", "Company", number, "not found")
+
+                if completed % batch_size == 0:
+                    flush()
+
+    finally:
+        flush()
+
+    log("    ", len(found), "companies found,", len(numbers) - len(found) - failed, "not found,", failed, "failed")
+
+    if not found:
+        return pd.DataFrame()
+
+    # match the types of rows read from the CSV (e.g. missing values as NaN), so they combine as if read from the file
+    data = pd.concat(found, ignore_index=True)
+    return pd.read_csv(io.StringIO(data.to_csv(index=False, quoting=csv.QUOTE_ALL)), dtype=str)
+
+
+def search_by_number(number, retries=3):
+    """
+    Search for a company number, retrying with a growing pause if the request or page fails.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return get_search_page(number, search_by=1)
         except Exception as error:
-            log(error)
-            return False
+            if attempt == retries:
+                raise
+            log("    ", "Search for company", number, "failed, retrying:", repr(error))
+            pause(2 ** attempt)
 
 
 def get_search_page(term, search_by=0, sort_by="IncorporationDate", sort_direction=0, page=1):
@@ -293,9 +744,11 @@ def get_search_page(term, search_by=0, sort_by="IncorporationDate", sort_directi
     
     index_date = datetime.now().strftime("%Y-%m-%d")
 
-    # TODO: handle exceptions, pause and retry a few times before giving up?
+    # transient HTTP errors are retried by get_url; anything else is raised, for search_by_number to retry the
+    # page or the name search to resume from its checkpoint
 
     with get_url(url) as f:
+        archive_page("search", f"{search_by}/{term}/{page}", url, f.status_code, f.content, f.encoding)
         soup = bs4.BeautifulSoup(f.content, "lxml")
 
         table = soup.find_all("table")[0]
@@ -325,52 +778,16 @@ def get_search_page(term, search_by=0, sort_by="IncorporationDate", sort_directi
         return df
 
 
-def write_search_by_number_not_found(number):
-    filepath = data_dir + "sources/search/numbers/not-found.csv"
-
-    file_exists = os.path.isfile(filepath)
+def write_search_by_number_not_found(numbers):
+    file_exists = os.path.isfile(not_found_filepath)
     add_header = not file_exists
 
-    rows = [{
-        "Number": number,
+    data = pd.DataFrame({
+        "Number": numbers,
         "Index Date": datetime.now().strftime("%Y-%m-%d")
-    }]
-    data = pd.DataFrame(rows)
+    })
 
-    data.to_csv(filepath, mode="a", index=False, header=add_header, quoting=csv.QUOTE_ALL)
-
-
-def update_search_status(term, page, data):
-    with open(data_dir + "sources/status.json", "r+") as fp:
-        status = json.load(fp)
-
-        if term not in status["search"]["names"]:
-            status["search"]["names"][term] = {}
-
-        records = data.to_dict("records")
-
-        status["search"]["names"][term]["latest"] = {
-            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "page": page,
-            "rows": len(records),
-            "last_row": records.pop()
-        }
-
-        # overwrite file with latest details
-        fp.seek(0)
-        fp.write(json.dumps(status, indent=2))
-        fp.truncate()
-
-
-def write_search_page(term, page, data):
-    filepath = data_dir + "sources/search/names/" + term + ".csv"
-
-    file_exists = os.path.isfile(filepath)
-    add_header = not file_exists
-
-    data.to_csv(filepath, mode="a", index=False, header=add_header, quoting=csv.QUOTE_ALL)
-
-    update_search_status(term, page, data)
+    data.to_csv(not_found_filepath, mode="a", index=False, header=add_header, quoting=csv.QUOTE_ALL)
 
 
 def write_search_by_number_page(data):
@@ -383,17 +800,19 @@ def write_search_by_number_page(data):
 
 
 def read_search_files(sources):
-    data = pd.DataFrame()
+    """
+    Read the search results, returning {"names": {term: data}, "numbers": data}.
+    """
+    search = {"names": {}, "numbers": pd.DataFrame()}
 
     # company name searches
     for term in sources["search"]["names"]:
-        filepath = data_dir + "sources/search/names/" + term + ".csv"
+        filepath = search_filepath(term)
         if os.path.isfile(filepath):
             try:
                 log("    ", "Reading data for", term)
 
-                term_data = pd.read_csv(filepath)
-                data = pd.concat([data, term_data])
+                search["names"][term] = pd.read_csv(filepath)
 
             except UnicodeDecodeError as error:
                 log("    ", "ERROR:", error)
@@ -406,14 +825,22 @@ def read_search_files(sources):
         try:
             log("    ", "Reading data for number searches")
 
-            number_data = pd.read_csv(numbers_filepath)
-            data = pd.concat([data, number_data])
+            search["numbers"] = pd.read_csv(numbers_filepath)
 
         except UnicodeDecodeError as error:
             log("    ", "ERROR:", error)
     else:
         log("      ", "WARNING: File missing for number searches")
 
+    return search
+
+
+def combine_search_data(search):
+    """
+    Combine search results from read_search_files into one de-duplicated list, sorted by number.
+    """
+    data = pd.concat([pd.DataFrame()] + list(search["names"].values()) + [search["numbers"]])
+
     # sort
     if not data.empty:
         # drop duplicates keeping last (so last fetched row kept)
@@ -427,28 +854,20 @@ def read_search_files(sources):
 
 def load_details_file():
     """
-    Load the details.json file which stores scraped details per company number.
-    Returns dict mapping Number -> details dict.
+    Open the details store which holds scraped details per company number.
+    Returns a DetailsStore, a mapping of Number -> details dict.
     """
-    if not os.path.isdir(os.path.dirname(details_filepath)):
-        os.makedirs(os.path.dirname(details_filepath), exist_ok=True)
+    details = DetailsStore(details_filepath)
 
-    if os.path.isfile(details_filepath):
+    # details were previously kept in a single details.json, carry them over on first use
+    json_filepath = os.path.splitext(details_filepath)[0] + ".json"
+    if os.path.isfile(json_filepath):
         try:
-            with open(details_filepath, "r", encoding="utf-8") as fp:
-                return json.load(fp)
+            migrate_json(json_filepath, details)
         except Exception as e:
-            log("    ", "WARNING: Could not read details file:", e)
-            return {}
-    return {}
-
+            log("    ", "WARNING: Could not migrate details file:", e)
 
-def save_details_file(details):
-    try:
-        with open(details_filepath, "w", encoding="utf-8") as fp:
-            json.dump(details, fp, indent=2, ensure_ascii=False)
-    except Exception as e:
-        log("    ", "ERROR: Could not write details file:", e)
+    return details
 
 
 def _normalize_label(label: str) -> str:
@@ -686,9 +1105,190 @@ def parse_registered_address(soup: bs4.BeautifulSoup) -> str:
     return ""
 
 
-def fetch_details_for_list(number_url_pairs, max_requests=None, min_sleep=1.0, max_sleep=3.0, force=False):
+def element_text(element, separator=" "):
+    """
+    Text of an lxml element, matching BeautifulSoup's get_text(separator, strip=True).
+    """
+    parts = []
+    for node in element.iter():
+        # comments and processing instructions have no text of their own, but may be followed by some
+        if isinstance(node.tag, str) and node.text:
+            parts.append(node.text)
+        if node is not element and node.tail:
+            parts.append(node.tail)
+
+    return separator.join(part.strip() for part in parts if part.strip())
+
+
+def parse_documents_link(a, label_text=None):
+    """
+    Documents url/count/BusinessEntityId from a purchasefileanddocumentlist link.
+    """
+    full_url = urllib.parse.urljoin(registry_url, a.get("href").strip())
+    m = re.search(r"(\d[\d,]*)", element_text(a) if label_text is None else label_text)
+    count = int(m.group(1).replace(",", "")) if m else 0
+
+    beid = None
+    v = urllib.parse.parse_qs(urllib.parse.urlparse(full_url).query).get("BusinessEntityId")
+    if v:
+        try:
+            beid = int(v[0])
+        except Exception:
+            beid = v[0]
+
+    return {"url": full_url, "count": count, "BusinessEntityId": beid}
+
+
+def parse_company_html(content) -> dict:
+    """
+    Parse a company details page in a single pass over the document, returning
+      {
+        "main": { normalized_key: value, ... },
+        "previous_names": [ {name, status}, ... ],
+        "agents": [ {agent, address}, ... ],
+        "registered_address": <address>,
+        "documents": {url, count, BusinessEntityId} or None
+      }
+
+    main/previous_names/agents match parse_company_page, and registered_address
+    and documents follow the same fallbacks as the BeautifulSoup parsers, but the
+    page is parsed once with lxml and every element visited once.
+    """
+    # lxml parsers can't be shared between the details fetching threads
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+    else:
+        parser = lxml.html.HTMLParser()
+
+    parsed = {"main": {}, "previous_names": [], "agents": [], "registered_address": "", "documents": None}
+    if not content.strip():
+        return parsed
+
+    root = lxml.html.document_fromstring(content, parser=parser)
+
+    # one traversal collecting everything the heuristics below need, in document order
+    tables = []
+    headings = []
+    address_tags = []
+    documents_link = None
+    for position, el in enumerate(root.iter()):
+        tag = el.tag
+        if not isinstance(tag, str):
+            continue
+        if tag == "table":
+            tables.append((position, el))
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            headings.append((position, el))
+        elif tag == "a" and documents_link is None and re.search(r"purchasefileanddocumentlist", el.get("href") or "", flags=re.I):
+            documents_link = el
+
+        cid = " ".join(filter(None, [el.get("class"), el.get("id")]))
+        if cid and re.search(r"\baddress\b", cid, flags=re.I):
+            address_tags.append(el)
+
+    # previous names and agents tables follow their heading, or are recognised by their header cells
+    def table_after(position):
+        for table_position, table in tables:
+            if table_position > position:
+                return table
+        return None
+
+    names_table = None
+    agents_table = None
+    for position, h in headings:
+        hid = (h.get("id") or "").lower()
+        text = element_text(h, "")
+        if names_table is None and (hid == "names" or re.search(r"previous\s+names", text, flags=re.I)):
+            names_table = table_after(position)
+        if agents_table is None and (hid == "agents" or re.search(r"registered\s+agents?", text, flags=re.I)):
+            agents_table = table_after(position)
+
+    main = None
+    for _, table in tables:
+        rows = list(table.iter("tr"))
+        cells = [(r.find(".//th"), r.find(".//td")) for r in rows]
+
+        if main is None and any(th is not None and td is not None for th, td in cells):
+            details = parse_main_details_rows(cells)
+            if details:
+                main = details
+
+        if names_table is None or agents_table is None:
+            header_cells = [element_text(th, "").lower() for th in table.iter("th")]
+            if names_table is None and any("name" in h for h in header_cells) and any("status" in h for h in header_cells):
+                names_table = table
+            if agents_table is None and any("agent" in h for h in header_cells) and any("address" in h for h in header_cells):
+                agents_table = table
+
+    main = main or {}
+    parsed["main"] = main
+
+    for key, table in (("previous_names", names_table), ("agents", agents_table)):
+        if table is None:
+            continue
+        first, second = ("name", "status") if key == "previous_names" else ("agent", "address")
+        for r in table.iter("tr"):
+            tds = list(r.iter("td"))
+            if not tds:
+                continue
+            value = {first: element_text(tds[0]), second: element_text(tds[1]) if len(tds) >= 2 else ""}
+            if value[first] or (key == "agents" and value[second]):
+                parsed[key].append(value)
+
+    # registered address: main table first, then the first agent's address, then page heuristics
+    for key in ("registered_office_address", "registered_address", "place_of_business", "registered_office", "address"):
+        if main.get(key):
+            parsed["registered_address"] = main[key]
+            break
+    else:
+        if parsed["agents"] and parsed["agents"][0].get("address"):
+            parsed["registered_address"] = parsed["agents"][0]["address"]
+        elif address_tags:
+            parsed["registered_address"] = ", ".join(filter(None, (element_text(el) for el in address_tags)))
+
+        if not parsed["registered_address"]:
+            m = re.search(r"(Registered (Office|Address)[^\n]*\n)([\s\S]{0,300})", element_text(root, "\n"), flags=re.I)
+            if m:
+                lines = [l.strip() for l in m.group(3).split("\n") if l.strip()][:3]
+                parsed["registered_address"] = ", ".join(lines)
+
+    # documents: prefer the link in the main table, otherwise any documents link on the page
+    if main.get("documents"):
+        parsed["documents"] = main["documents"]
+    elif documents_link is not None:
+        parsed["documents"] = parse_documents_link(documents_link)
+
+    return parsed
+
+
+def parse_main_details_rows(cells) -> dict:
+    details = {}
+    for th, td in cells:
+        if th is None or td is None:
+            continue
+        value = element_text(td)
+        key = _normalize_label(element_text(th))
+        if key:
+            details[key] = value
+
+        # documents link in the value cell, as parse_main_details_table
+        a = next((a for a in td.iter("a") if a.get("href") is not None), None)
+        if a is not None:
+            href = a.get("href").strip()
+            link_text = element_text(a)
+            if re.search(r"document", href, flags=re.I) or re.search(r"document", link_text, flags=re.I):
+                details["documents"] = parse_documents_link(a, link_text)
+
+    return details
+
+
+@instrument
+def fetch_details_for_list(number_url_pairs, max_requests=None, rate=0.5, workers=4, force=False):
     """
     number_url_pairs: list of (Number, URL)
+    rate: requests per second allowed to the registry, shared by all workers
+    workers: number of details pages fetched concurrently
     """
     if max_requests is not None:
         try:
@@ -697,10 +1297,11 @@ def fetch_details_for_list(number_url_pairs, max_requests=None, min_sleep=1.0, m
             max_requests = None
 
     details = load_details_file()
-    count = 0
 
+    # build the work list up front so max_requests caps actual requests
+    to_fetch = []
     for number, url in number_url_pairs:
-        if max_requests is not None and count >= max_requests:
+        if max_requests is not None and len(to_fetch) >= max_requests:
             log("    ", f"Reached max_requests limit ({max_requests}). Stopping.")
             break
 
@@ -713,178 +1314,306 @@ def fetch_details_for_list(number_url_pairs, max_requests=None, min_sleep=1.0, m
             log("    ", f"Skipping {number}: details already fetched (use force to re-fetch)")
             continue
 
-        try:
-            log("    ", f"Fetching details for {number} -> {url}")
-            r = get_url(url)
-            if getattr(r, "status_code", None) is not None and r.status_code != 200:
-                log("    ", f"Warning: received status {r.status_code} for {url}")
-                # store metadata that we attempted
-                details[number] = {
-                    "url": url,
-                    "fetched": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "http_status": r.status_code
-                }
-                save_details_file(details)
+        to_fetch.append((number, url))
+
+    # polite request rate to the registry, however many workers are running
+    set_rate_limit(urllib.parse.urlsplit(registry_url).netloc, rate)
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch_company_details, number, url): number for number, url in to_fetch}
+
+        for future in as_completed(futures):
+            number = futures[future]
+            try:
+                details[number] = future.result()
+            except Exception as e:
+                log("    ", f"Error fetching details for {number}: {e}")
                 continue
 
-            # Use text if requests.Response-like, or .content if a file-like was returned
-            content = getattr(r, "text", None) or getattr(r, "content", None) or ""
-            soup = bs4.BeautifulSoup(content, "html.parser")
-
-            parsed = parse_company_page(soup)
-            main = parsed.get("main", {})
-            prev_names = parsed.get("previous_names", [])
-            agents = parsed.get("agents", [])
-
-            # prefer normalized main fields for registered address
-            reg_addr = ""
-            if main:
-                reg_addr = main.get("registered_office_address") \
-                           or main.get("registered_address") \
-                           or main.get("place_of_business") \
-                           or ""
-
-            # fallback to parse_registered_address heuristics if still empty
-            if not reg_addr:
-                reg_addr = parse_registered_address(soup)
-
-            # agent: collapse first agent into a single string (name + address)
-            agent_str = ""
-            if agents:
-                first_agent = agents[0]
-                agent_str = first_agent.get("agent", "") or ""
-                if first_agent.get("address"):
-                    if agent_str:
-                        agent_str = f"{agent_str} - {first_agent.get('address')}"
-                    else:
-                        agent_str = first_agent.get("address")
-
-            # documents: prefer structured documents from main if present
-            docs = None
-            if main and main.get("documents"):
-                docs = main.get("documents")
-            else:
-                # try to find purchase link anywhere on the page as fallback
-                a = soup.find("a", href=re.compile(r"purchasefileanddocumentlist", flags=re.I))
-                if a:
-                    href = a.get("href").strip()
-                    full_url = urllib.parse.urljoin(registry_url, href)
-                    text = a.get_text(" ", strip=True)
-                    m = re.search(r"(\d[\d,]*)", text)
-                    count = int(m.group(1).replace(",", "")) if m else 0
-                    parsed = urllib.parse.urlparse(full_url)
-                    qs = urllib.parse.parse_qs(parsed.query)
-                    beid = None
-                    if "BusinessEntityId" in qs:
-                        v = qs.get("BusinessEntityId")
-                        if v:
-                            try:
-                                beid = int(v[0])
-                            except Exception:
-                                beid = v[0]
-                    docs = {"url": full_url, "count": count, "BusinessEntityId": beid}
-
-            details[number] = {
-                "url": url,
-                "fetched": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "http_status": getattr(r, "status_code", None) or "",
-                "registered_address": reg_addr,
-                "previous_names": prev_names,
-                "agent": agent_str,
-                "main": main,
-                "agents": agents,
-                "documents": docs
-            }
-
-            save_details_file(details)
             count += 1
 
-            # polite sleep
-            sleep = random.uniform(min_sleep, max_sleep)
-            log("    ", f"... pausing for {sleep:.2f} seconds ...")
-            time.sleep(sleep)
-
-        except Exception as e:
-            log("    ", f"Error fetching details for {number}: {e}")
+    details.close()
 
     log("    ", f"Finished fetching details. Total fetched this run: {count}")
     return details
 
 
+def fetch_company_details(number, url):
+    """
+    Fetch and parse a single company details page, returning the record kept in the details store.
+    """
+    log("    ", f"Fetching details for {number} -> {url}")
+    r = get_url(url)
+
+    # keep the raw page, so details can be re-parsed later without fetching again
+    archive_page("details", number, url, r.status_code, r.content, r.encoding)
+
+    if r.status_code != 200:
+        log("    ", f"Warning: received status {r.status_code} for {url}")
+        # store metadata that we attempted
+        return {
+            "url": url,
+            "fetched": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "http_status": r.status_code
+        }
+
+    parsed = parse_company_html(r.text or "")
+
+    return build_details_record(url, r.status_code, parsed)
+
+
+def reparse_archived_page(entry):
+    """
+    Rebuild a details record from an archived page, as fetch_company_details would have when it was fetched.
+    """
+    if entry["status"] != 200:
+        return {"url": entry["url"], "fetched": entry["fetched"], "http_status": entry["status"]}
+
+    parsed = parse_company_html(read_page(entry))
+
+    return build_details_record(entry["url"], entry["status"], parsed, fetched=entry["fetched"])
+
+
+@instrument
+def reparse_company_details(processes=None):
+    """
+    Public function invoked by update.py
+
+    Rebuild the details store from the archived details pages, using the current
+    parsers and without making any requests. Details for companies with no
+    archived page are left as they are.
+    """
+    log("# Companies Registry - re-parsing archived details pages")
+
+    entries = list(latest_pages("details").values())
+    if not entries:
+        log("    ", "No archived details pages found in", page_archive.archive_dir)
+        return
+
+    details = load_details_file()
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        records = executor.map(reparse_archived_page, entries, chunksize=64)
+        for entry, record in zip(entries, records):
+            details[entry["key"]] = record
+            count += 1
+
+    details.close()
+
+    log("    ", count, "company details re-parsed from the archive")
+
+
+def build_details_record(url, http_status, parsed, fetched=None):
+    """
+    Build the record kept in the details store from the output of parse_company_html.
+    """
+    # agent: collapse first agent into a single string (name + address)
+    agents = parsed["agents"]
+    agent_str = ""
+    if agents:
+        first_agent = agents[0]
+        agent_str = first_agent.get("agent", "") or ""
+        if first_agent.get("address"):
+            if agent_str:
+                agent_str = f"{agent_str} - {first_agent.get('address')}"
+            else:
+                agent_str = first_agent.get("address")
+
+    return {
+        "url": url,
+        "fetched": fetched or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "http_status": http_status,
+        "registered_address": parsed["registered_address"],
+        "previous_names": parsed["previous_names"],
+        "agent": agent_str,
+        "main": parsed["main"],
+        "agents": agents,
+        "documents": parsed["documents"]
+    }
+
+
 def build_number_url_pairs_from_outputs(targets):
     """
     Build a list of (Number, URL) pairs from existing outputs.
     targets: list containing any of 'live', 'non-live', 'new', or 'all'
-    For 'new', we look for numbers present in outputs which are not yet in details.json.
+    For 'new', we look for numbers present in outputs which are not yet in the details store.
+    """
+    live_df, non_live_df = read_company_outputs()
+
+    return build_number_url_pairs(live_df, non_live_df, targets)
+
+
+def read_company_outputs():
+    """
+    The companies-live and companies-non-live outputs, if present.
     """
-    pairs = []
-    # load outputs if present
     live_path = data_dir + "outputs/companies-live.csv"
     non_live_path = data_dir + "outputs/companies-non-live.csv"
 
     live_df = pd.read_csv(live_path, dtype=str) if os.path.isfile(live_path) else pd.DataFrame()
     non_live_df = pd.read_csv(non_live_path, dtype=str) if os.path.isfile(non_live_path) else pd.DataFrame()
 
-    # helper to extract pairs from df
-    def pairs_from_df(df):
-        out = []
-        if df.empty:
-            return out
-        if "Number" not in df.columns:
-            log("    ", "WARNING: Dataframe has no Number column - skipping")
-            return out
-        # 'URL' column expected; if absent, try other columns that look like urls/details
-        url_cols = [c for c in df.columns if c.lower() == "url" or "details" in c.lower()]
-        url_col = url_cols[0] if url_cols else None
-
-        for _, row in df.iterrows():
-            num = str(row.get("Number", "")).strip()
-            url = ""
-            if url_col:
-                url = str(row.get(url_col, "")).strip()
-            out.append((num, url))
-        return out
+    return live_df, non_live_df
+
 
+def build_number_url_pairs(live_df, non_live_df, targets):
+    """
+    Build a list of (Number, URL) pairs from the companies-live and companies-non-live outputs.
+    """
+    frames = []
     if "live" in targets:
-        pairs.extend(pairs_from_df(live_df))
+        frames.append(pairs_from_df(live_df))
     if "non-live" in targets:
-        pairs.extend(pairs_from_df(non_live_df))
+        frames.append(pairs_from_df(non_live_df))
 
     # deduplicate by Number keeping first seen
-    dedup = {}
-    for num, url in pairs:
-        if num not in dedup:
-            dedup[num] = url
+    pairs = pd.concat(frames + [pd.DataFrame(columns=["Number", "URL"])], ignore_index=True)
+    pairs = pairs.drop_duplicates(subset=["Number"], keep="first")
 
     # handle 'new' target: produce pairs that are not in details file
     if "new" in targets:
         details = load_details_file()
-        new_pairs = []
-        for num, url in dedup.items():
-            if num not in details:
-                new_pairs.append((num, url))
         # return only new pairs
-        return new_pairs
+        pairs = pairs[~pairs["Number"].isin(list(details))]
+
+    return list(zip(pairs["Number"], pairs["URL"]))
+
+
+def pairs_from_df(df):
+    """
+    Number and URL columns from a companies output, as strings.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=["Number", "URL"])
+    if "Number" not in df.columns:
+        log("    ", "WARNING: Dataframe has no Number column - skipping")
+        return pd.DataFrame(columns=["Number", "URL"])
+
+    # 'URL' column expected; if absent, try other columns that look like urls/details
+    url_cols = [c for c in df.columns if c.lower() == "url" or "details" in c.lower()]
+    url_col = url_cols[0] if url_cols else None
+
+    return pd.DataFrame({
+        "Number": df["Number"].astype(str).str.strip(),
+        "URL": df[url_col].astype(str).str.strip() if url_col else ""
+    })
+
+
+# weights used to rank companies for a details refresh, see refresh_priorities
+refresh_weights = {
+    "age_per_year": 1.0,      # per year since the details were fetched
+    "not_live": 0.25,         # multiplies the age score of companies that aren't live, whose details rarely change
+    "status_changed": 10.0,   # the search results show a different status to the fetched details
+    "failed": 2.0,            # the last fetch didn't return the details page
+    "never_fetched": 20.0
+}
+
+# multiplies the age score by registry type, e.g. business names have no agents or documents to keep up to date
+refresh_registry_weights = {
+    "Business Name": 0.5
+}
+
+# companies refreshed by the 'stale' target when no maximum number of requests is given
+stale_refresh_max = 500
+
+
+def refresh_priorities(companies, details):
+    """
+    Rank companies (Number, URL, Status and Registry Type from the companies outputs) for a details refresh.
+    Returns a dataframe of Number, URL, Fetched and Score, highest score first.
+    """
+    companies = companies.dropna(subset=["Number"]).copy()
+    companies["Number"] = companies["Number"].astype(str).str.strip()
+    companies = companies.drop_duplicates(subset=["Number"], keep="first")
+
+    # fetched date, status on the details page and HTTP status of each company's last fetch
+    records = pd.DataFrame(
+        [(number, record.get("fetched"), (record.get("main") or {}).get("status"), record.get("http_status"))
+         for number, record in details.items()],
+        columns=["Number", "Fetched", "Details Status", "HTTP Status"]
+    )
+    details.close()
+    ranked = companies.merge(records, on="Number", how="left")
+
+    fetched = pd.to_datetime(ranked["Fetched"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    age_years = ((pd.Timestamp.now() - fetched).dt.days / 365).fillna(0)
+
+    age_weight = ranked["Registry Type"].map(refresh_registry_weights).fillna(1.0)
+    age_weight = age_weight.where(ranked["Status"] == "Live", age_weight * refresh_weights["not_live"])
+
+    details_status = ranked["Details Status"].fillna("").astype(str).str.strip().str.lower()
+    search_status = ranked["Status"].fillna("").astype(str).str.strip().str.lower()
+    status_changed = (details_status != "") & (details_status != search_status)
 
-    # otherwise return dedup pairs as list
-    return list(dedup.items())
+    failed = ranked["Fetched"].notna() & (pd.to_numeric(ranked["HTTP Status"], errors="coerce") != 200)
 
+    ranked["Score"] = age_years * refresh_weights["age_per_year"] * age_weight \
+        + status_changed * refresh_weights["status_changed"] \
+        + failed * refresh_weights["failed"] \
+        + ranked["Fetched"].isna() * refresh_weights["never_fetched"]
 
-def update_company_details(targets=("new",), max_requests=None, min_sleep=1.0, max_sleep=3.0, force=False, interactive=True):
+    ranked["URL"] = ranked["URL"].astype(str).str.strip()
+    ranked = ranked.sort_values(by="Score", ascending=False, kind="stable")
+
+    return ranked[["Number", "URL", "Fetched", "Score"]]
+
+
+def add_stale_pairs(pairs, companies, max_requests=None, force=False):
+    """
+    Add the companies most in need of a details refresh to pairs, up to max_requests in total
+    (or stale_refresh_max of them if there's no maximum).
+    """
+    ranked = refresh_priorities(companies, load_details_file())
+
+    # fetch_details_for_list is forced for stale companies, so drop the already fetched from the other targets here
+    if not force:
+        fetched = set(ranked.loc[ranked["Fetched"].notna(), "Number"])
+        pairs = [(number, url) for number, url in pairs if number not in fetched]
+
+    ranked = ranked[~ranked["Number"].isin([number for number, _ in pairs])]
+    # without a maximum every company would be queued, i.e. a full re-crawl, so use the default budget
+    if max_requests is None:
+        ranked = ranked.head(stale_refresh_max)
+    else:
+        ranked = ranked.head(max(0, int(max_requests) - len(pairs)))
+
+    log("    ", len(ranked), "companies selected for a details refresh, scores",
+        f"{ranked['Score'].max():.2f} to {ranked['Score'].min():.2f}" if len(ranked) else "n/a")
+
+    return pairs + list(zip(ranked["Number"], ranked["URL"]))
+
+
+def update_company_details(targets=("new",), max_requests=None, rate=0.5, workers=4, force=False, interactive=True,
+                           outputs=None):
     """
     Public function invoked by update.py
 
-    targets: list-like of 'live', 'non-live', 'new' (or mix), default ('new',)
+    targets: list-like of 'live', 'non-live', 'new', 'stale' (or mix), default ('new',)
+             'stale' fills what's left of max_requests with the companies most in need of a refresh
+             (up to stale_refresh_max of them if max_requests isn't given)
     max_requests: optional int limit
-    min_sleep/max_sleep: seconds between requests
-    force: if True, re-fetch company details even if present in details.json
+    rate: requests per second allowed to the registry
+    workers: number of details pages fetched concurrently
+    force: if True, re-fetch company details even if present in the details store
     interactive: if True, prompt user to confirm
+    outputs: outputs from process_data to take companies from, instead of reading the output files
     """
     if isinstance(targets, str):
         targets = [targets]
 
     # build pairs of Number/URL to fetch
-    pairs = build_number_url_pairs_from_outputs(targets)
+    if outputs is not None:
+        live_df, non_live_df = outputs["companies-live"], outputs["companies-non-live"]
+    else:
+        live_df, non_live_df = read_company_outputs()
+    pairs = build_number_url_pairs(live_df, non_live_df, targets)
+
+    if "stale" in targets:
+        pairs = add_stale_pairs(pairs, pd.concat([live_df, non_live_df]), max_requests, force)
+        # the stale companies have been fetched before, so need re-fetching regardless
+        force = True
 
     if not len(pairs):
         log("    ", "No company numbers/URLs found for requested targets.")
@@ -901,4 +1630,4 @@ def update_company_details(targets=("new",), max_requests=None, min_sleep=1.0, m
             return
 
     # perform the fetches
-    fetch_details_for_list(pairs, max_requests=max_requests, min_sleep=min_sleep, max_sleep=max_sleep, force=force)
+    fetch_details_for_list(pairs, max_requests=max_requests, rate=rate, workers=workers, force=force)
@@ -0,0 +1,272 @@
+import os
+import json
+import threading
+from datetime import datetime
+from collections.abc import Mapping
+from src.helpers import log
+
+"""
+Company details store
+
+Scraped company details kept as an append-only JSON lines file, one
+{"number": ..., "details": ...} record per line. Saving a company appends a
+line rather than rewriting every company, and an index of byte offsets gives
+lookups by number without loading the whole file. Later records for a number
+replace earlier ones; compaction drops the replaced records once they make up
+most of the file.
+
+    details = DetailsStore("data/gov.im/companies/sources/details/details.jsonl")
+    details["000123C"] = {"url": ..., "fetched": ...}
+    details.get("000123C")
+    details.close()
+
+"""
+
+# compact once the file holds this many records per company, and at least compact_min_records
+compact_ratio = 2.0
+compact_min_records = 1000
+
+
+class DetailsStore(Mapping):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.index_filepath = filepath + ".idx"
+        self.lock = threading.Lock()
+
+        # number -> (offset, length) of its latest record
+        self.index = {}
+        self.records = 0
+        # the file up to this size is all in the index (records appended by another store after it may not be)
+        self.scanned = 0
+        self.scanned_records = 0
+        # when the file was last compacted, so anything holding offsets into it can tell they've moved
+        self.compacted = None
+        self.reader = None
+        self.writer = None
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if not os.path.isfile(filepath):
+            open(filepath, "ab").close()
+
+        self.load_index()
+
+    def load_index(self):
+        """
+        Load the saved index and scan any records appended since it was saved.
+        """
+        size = os.path.getsize(self.filepath)
+        indexed_size = 0
+
+        if os.path.isfile(self.index_filepath):
+            try:
+                with open(self.index_filepath, "r", encoding="utf-8") as fp:
+                    saved = json.load(fp)
+                # a smaller file means it was replaced, so the saved offsets can't be trusted
+                if saved["size"] <= size:
+                    self.index = {number: tuple(entry) for number, entry in saved["index"].items()}
+                    self.records = saved["records"]
+                    self.compacted = saved.get("compacted")
+                    indexed_size = saved["size"]
+                    self.scanned, self.scanned_records = indexed_size, self.records
+            except Exception as e:
+                log("    ", "WARNING: Could not read details index, rebuilding:", e)
+
+        if indexed_size < size:
+            self.scan(indexed_size)
+            self.save_index()
+
+    def scan(self, offset, truncate=True):
+        """
+        Index the records from offset to the end of the file. An incomplete last line is truncated, unless
+        truncate is False (when another store may still be writing it), in which case it's left for a later scan.
+        """
+        with open(self.filepath, "rb") as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    if not truncate:
+                        return
+                    # only the last line can be missing its newline: a run stopped part way through writing it,
+                    # so drop it to keep appends line aligned
+                    log("    ", "WARNING: Truncating incomplete last details record at byte", offset)
+                    fp.close()
+                    os.truncate(self.filepath, offset)
+                    return
+
+                try:
+                    number = json.loads(line)["number"]
+                except Exception as e:
+                    # a complete but unreadable line, leave it in place and keep the records after it
+                    log("    ", "WARNING: Skipping unreadable details record at byte", offset, "-", e)
+                else:
+                    self.index[number] = (offset, len(line))
+                    self.records += 1
+
+                offset += len(line)
+                self.scanned = offset
+                self.scanned_records = self.records
+
+    def catch_up(self):
+        """
+        Index any records another store has appended to the file since this one last read it, so saving the
+        index (which records the size it covers) or compacting can't drop them.
+        """
+        if self.scanned < os.path.getsize(self.filepath):
+            # records this store appended after the first unread byte are scanned again, so count from there
+            self.records = self.scanned_records
+            self.scan(self.scanned, truncate=False)
+
+    def save_index(self):
+        self.catch_up()
+
+        tmp_filepath = self.index_filepath + ".tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as fp:
+            json.dump({
+                "size": self.scanned,
+                "records": self.records,
+                "compacted": self.compacted,
+                "index": self.index
+            }, fp)
+        os.replace(tmp_filepath, self.index_filepath)
+
+    def read_record(self, offset, length):
+        if self.reader is None:
+            self.reader = open(self.filepath, "rb")
+        self.reader.seek(offset)
+
+        return json.loads(self.reader.read(length))["details"]
+
+    def __getitem__(self, number):
+        with self.lock:
+            offset, length = self.index[number]
+            return self.read_record(offset, length)
+
+    def __contains__(self, number):
+        return number in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def items(self):
+        """
+        All companies and their details, read in file order.
+        """
+        # snapshot the index, and only hold the lock for each read, so the caller can use the store while iterating
+        with self.lock:
+            entries = sorted(self.index.items(), key=lambda item: item[1][0])
+
+        for number, (offset, length) in entries:
+            with self.lock:
+                record = self.read_record(offset, length)
+            yield number, record
+
+    def size(self):
+        """
+        Bytes of records written so far, including any appended by this instance.
+        """
+        with self.lock:
+            if self.writer is not None:
+                return self.writer.tell()
+        return os.path.getsize(self.filepath)
+
+    def updated_since(self, offset):
+        """
+        Companies whose latest record was written at or after the given byte offset.
+        """
+        return [number for number, (record_offset, _) in self.index.items() if record_offset >= offset]
+
+    def __setitem__(self, number, details):
+        line = (json.dumps({"number": number, "details": details}, ensure_ascii=False) + "\n").encode("utf-8")
+
+        with self.lock:
+            if self.writer is None:
+                self.writer = open(self.filepath, "ab")
+
+            self.writer.write(line)
+            # flush so the record is readable straight away and survives an interrupted run
+            self.writer.flush()
+            # appends go to the end of the file, which another store may have moved, so take the offset after
+            offset = self.writer.tell() - len(line)
+
+            self.index[number] = (offset, len(line))
+            self.records += 1
+            if offset == self.scanned:
+                self.scanned += len(line)
+                self.scanned_records = self.records
+
+    def update(self, details):
+        for number, record in details.items():
+            self[number] = record
+
+    def needs_compaction(self):
+        return self.records >= compact_min_records and self.records > compact_ratio * len(self.index)
+
+    def compact(self):
+        """
+        Rewrite the file with only the latest record for each company.
+        """
+        with self.lock:
+            self.close_files()
+            self.catch_up()
+
+            tmp_filepath = self.filepath + ".tmp"
+            index = {}
+            offset = 0
+            with open(self.filepath, "rb") as src, open(tmp_filepath, "wb") as dst:
+                for number, (record_offset, length) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                    src.seek(record_offset)
+                    dst.write(src.read(length))
+                    index[number] = (offset, length)
+                    offset += length
+            os.replace(tmp_filepath, self.filepath)
+
+            log("    ", "Compacted details file from", self.records, "to", len(index), "records")
+            self.index = index
+            self.records = len(index)
+            self.scanned, self.scanned_records = offset, self.records
+            self.compacted = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.save_index()
+
+    def close_files(self):
+        for fp in (self.reader, self.writer):
+            if fp is not None:
+                fp.close()
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        """
+        Compact if needed and save the index, so the next load doesn't rescan.
+        """
+        if self.needs_compaction():
+            self.compact()
+            return
+
+        with self.lock:
+            self.close_files()
+            self.save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def migrate_json(json_filepath, store):
+    """
+    Import a details.json written by earlier versions into the store, then move it aside.
+    """
+    log("    ", "Migrating", json_filepath, "to", store.filepath)
+
+    with open(json_filepath, "r", encoding="utf-8") as fp:
+        details = json.load(fp)
+
+    store.update(details)
+    store.close()
+    os.replace(json_filepath, json_filepath + ".migrated")
+
+    log("    ", len(details), "companies migrated")
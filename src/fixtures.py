@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src import helpers
+from src.helpers import log
+
+"""
+HTTP fixture recording and replay
+
+A local stand-in HTTP server that requests are routed through when
+`helpers.fixture_server_url` is set (see `helpers.fixture_url`). In record mode it
+forwards each request upstream and stores the response in the fixture store; in
+replay mode it serves stored responses with configurable latency and error rate,
+so the fetchers can be exercised and benchmarked without network access.
+
+    python -m src.fixtures serve --mode replay --latency 0.2 --error-rate 0.05
+    python update.py --fixture-server http://127.0.0.1:8765 --planning-applications
+
+    python -m src.fixtures bench planning-weekly --mode record
+    python -m src.fixtures bench planning-weekly --latency 0.1
+
+"""
+
+fixtures_dir = ".cache/fixtures/"
+
+# response headers kept with a fixture
+stored_headers = ["Content-Type", "ETag", "Last-Modified"]
+
+# request headers passed upstream when recording
+forwarded_headers = ["User-Agent", "Accept", "Accept-Charset", "Content-Type"]
+
+
+def fixture_key(method, url, body=b""):
+    h = sha256()
+    h.update(method.encode("utf-8") + b" " + url.encode("utf-8") + b"\n")
+    h.update(body or b"")
+
+    return h.hexdigest()
+
+
+def fixture_path(store, key):
+    return os.path.join(store, key[:2], key)
+
+
+def load_fixture(store, key):
+    path = fixture_path(store, key)
+    if not os.path.isfile(path + ".json"):
+        return None
+
+    with open(path + ".json", "r", encoding="utf-8") as fp:
+        fixture = json.load(fp)
+    with open(path + ".body", "rb") as fp:
+        fixture["body"] = fp.read()
+
+    return fixture
+
+
+def save_fixture(store, key, fixture):
+    path = fixture_path(store, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + ".body", "wb") as fp:
+        fp.write(fixture["body"])
+
+    meta = {k: v for k, v in fixture.items() if k != "body"}
+    with open(path + ".json", "w", encoding="utf-8") as fp:
+        json.dump(meta, fp, indent=2)
+
+
+def upstream_url(path):
+    """
+    Reverse of `helpers.fixture_url`: /https/host/path?q -> https://host/path?q
+    """
+    parts = path.lstrip("/").split("/", 2)
+    if len(parts) < 2 or parts[0] not in ("http", "https"):
+        return None
+
+    return parts[0] + "://" + parts[1] + "/" + (parts[2] if len(parts) > 2 else "")
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store=fixtures_dir, mode="replay", latency=0.0, error_rate=0.0):
+        super().__init__(address, FixtureHandler)
+        self.store = store
+        self.mode = mode
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts = {"requests": 0, "recorded": 0, "replayed": 0, "missing": 0, "errors": 0}
+        self.counts_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_fixture("GET")
+
+    def do_POST(self):
+        self.handle_fixture("POST")
+
+    def handle_fixture(self, method):
+        server = self.server
+        server.count("requests")
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        url = upstream_url(self.path)
+        if url is None:
+            self.send_body(404, {"Content-Type": "text/plain"}, b"Not a fixture URL")
+            return
+
+        if server.mode == "replay":
+            if server.latency:
+                time.sleep(random.uniform(0.5, 1.5) * server.latency)
+            if random.random() < server.error_rate:
+                server.count("errors")
+                self.send_body(503, {"Content-Type": "text/plain"}, b"Injected error")
+                return
+
+        key = fixture_key(method, url, body)
+        if server.mode == "record":
+            fixture = self.record(method, url, body)
+            save_fixture(server.store, key, fixture)
+            server.count("recorded")
+        else:
+            fixture = load_fixture(server.store, key)
+            if fixture is None:
+                server.count("missing")
+                self.send_body(404, {"Content-Type": "text/plain"}, b"No fixture recorded for " + url.encode())
+                return
+            server.count("replayed")
+
+        # honour conditional requests so the HTTP cache can be exercised offline
+        etag = fixture["headers"].get("ETag")
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_body(304, {"ETag": etag}, b"")
+            return
+
+        self.send_body(fixture["status"], fixture["headers"], fixture["body"])
+
+    def record(self, method, url, body):
+        headers = {h: self.headers[h] for h in forwarded_headers if self.headers.get(h)}
+        r = helpers.get_session().request(method, url, data=body or None, headers=headers,
+                                          timeout=helpers.request_timeout)
+        log("    ", "Recorded", method, url, r.status_code)
+
+        return {
+            "method": method,
+            "url": url,
+            "status": r.status_code,
+            "headers": {h: r.headers[h] for h in stored_headers if r.headers.get(h)},
+            "recorded": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "body": r.content
+        }
+
+    def send_body(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    Start a fixture server in a background thread and route helpers requests through it.
+    """
+    server = FixtureServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    helpers.fixture_server_url = "http://" + host + ":" + str(server.server_address[1])
+
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    helpers.fixture_server_url = None
+
+
+"""
+Fetcher benchmarks
+
+Each fetcher runs against a temporary copy of its dataset directory, so
+recording and replaying start from the same state and the real data is untouched.
+"""
+
+
+def bench_companies_list(module_dir):
+    from src import companies
+    companies.data_dir = module_dir
+    with open(module_dir + "sources/sources.json") as fp:
+        sources = json.load(fp)
+    with open(module_dir + "sources/status.json") as fp:
+        status = json.load(fp)
+    companies.update_companies_list(sources, status)
+
+
+def bench_planning_weekly(module_dir):
+    from src import planning_applications
+    planning_applications.data_dir = module_dir
+    with open(module_dir + "sources/sources.json") as fp:
+        sources = json.load(fp)
+    for record_type in planning_applications.record_types:
+        if "weekly" in sources[record_type]:
+            planning_applications.update_weekly_files(sources[record_type]["weekly"], record_type, False)
+
+
+def bench_openstreetmap(module_dir):
+    from src import openstreetmap
+    openstreetmap.data_dir = module_dir
+    with open(module_dir + "sources/sources.json") as fp:
+        sources = json.load(fp)
+    openstreetmap.update_files(sources)
+
+
+fetchers = {
+    "companies-list": ("data/gov.im/companies/", bench_companies_list),
+    "planning-weekly": ("data/gov.im/planning-applications/", bench_planning_weekly),
+    "openstreetmap": ("data/openstreetmap/", bench_openstreetmap),
+}
+
+
+def bench(fetcher, mode="replay", store=fixtures_dir, latency=0.0, error_rate=0.0):
+    source_dir, func = fetchers[fetcher]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        module_dir = os.path.join(tmp_dir, source_dir)
+        shutil.copytree(source_dir, module_dir)
+
+        server = start_server(store=store, mode=mode, latency=latency, error_rate=error_rate)
+
+        # keep polite pauses when talking to the real services
+        pause_scale = helpers.pause_scale
+        if mode == "replay":
+            helpers.pause_scale = 0
+
+        start = time.perf_counter()
+        try:
+            func(module_dir)
+        finally:
+            elapsed = time.perf_counter() - start
+            helpers.pause_scale = pause_scale
+            stop_server(server)
+
+    result = {"fetcher": fetcher, "mode": mode, "seconds": round(elapsed, 3)}
+    result.update(server.counts)
+    if elapsed:
+        result["requests_per_second"] = round(server.counts["requests"] / elapsed, 2)
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record and replay HTTP fixtures for offline runs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run a fixture server")
+    serve_parser.add_argument("--port", type=int, default=8765)
+
+    bench_parser = subparsers.add_parser("bench", help="Run a fetcher against a fixture server and time it")
+    bench_parser.add_argument("fetcher", choices=sorted(fetchers))
+
+    for p in (serve_parser, bench_parser):
+        p.add_argument("--mode", choices=["record", "replay"], default="replay")
+        p.add_argument("--store", default=fixtures_dir, help="Fixture store directory")
+        p.add_argument("--latency", type=float, default=0.0, help="Mean seconds of added latency per replayed response")
+        p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of replayed requests answered with a 503")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = FixtureServer(("127.0.0.1", args.port), store=args.store, mode=args.mode,
+                               latency=args.latency, error_rate=args.error_rate)
+        log("Serving fixtures from", args.store, "in", args.mode, "mode on port", args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            log("Stopped:", server.counts)
+            sys.exit(0)
+    else:
+        print(json.dumps(bench(args.fetcher, mode=args.mode, store=args.store,
+                               latency=args.latency, error_rate=args.error_rate), indent=2))
@@ -1,7 +1,6 @@
+import io
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import shape
-from src.helpers import prompt
+from src.helpers import get_cached_url, get_url, instrument, prompt
 
 
 """
@@ -11,8 +10,13 @@ https://github.com/microsoft/GlobalMLBuildingFootprints/blob/main/scripts/make-g
 """
 
 data_dir = "data/microsoft/global-ml-building-footprints/"
+dataset_links_url = "https://minedbuildings.blob.core.windows.net/global-buildings/dataset-links.csv"
 
+# the dataset links index is only republished occasionally, so revalidate at most daily
+dataset_links_ttl = 24 * 60 * 60
 
+
+@instrument
 def global_ml_building_footprints(interactive=True):
     update_text = 'y'
     if interactive:
@@ -23,16 +27,31 @@ def global_ml_building_footprints(interactive=True):
     # this is the name of the geography you want to retrieve. update to meet your needs
     location = 'IsleofMan'
 
-    dataset_links = pd.read_csv("https://minedbuildings.blob.core.windows.net/global-buildings/dataset-links.csv")
+    dataset_links = pd.read_csv(io.BytesIO(get_cached_url(dataset_links_url, ttl=dataset_links_ttl)))
     greece_links = dataset_links[dataset_links.Location == location]
     for _, row in greece_links.iterrows():
-        df = pd.read_json(row.Url, lines=True)
-        df['geometry'] = df['geometry'].apply(shape)
-        gdf = gpd.GeoDataFrame(df, crs=4326)
-        gdf.to_file(f"{data_dir}sources/{row.QuadKey}.geojson", driver="GeoJSON")
+        # footprint files are gzipped line-delimited GeoJSON (e.g. .csv.gz)
+        compression = "gzip" if row.Url.endswith(".gz") else None
+        convert_footprints(get_url(row.Url).content, f"{data_dir}sources/{row.QuadKey}.geojson", compression)
 
     # TODO: merge into single GeoJSON file for outputs directory
 
 
+@instrument
+def convert_footprints(content, filepath, compression=None):
+    """
+    Convert a downloaded footprints file (GeoJSON features, one per line) to a GeoJSON file.
+    """
+    import geopandas as gpd
+    from shapely.geometry import shape
+
+    df = pd.read_json(io.BytesIO(content), lines=True, compression=compression)
+    df['geometry'] = df['geometry'].apply(shape)
+    gdf = gpd.GeoDataFrame(df, crs=4326)
+    gdf.to_file(filepath, driver="GeoJSON")
+
+    return gdf
+
+
 if __name__ == "__main__":
     global_ml_building_footprints()
@@ -1,8 +1,18 @@
-from hashlib import md5
+from hashlib import md5, sha256
+import os
+import sys
+import functools
+import json
+import time
+import threading
+import numpy as np
 import pandas as pd
 from typing import Optional, Iterable
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+import urllib.parse
 
 
 """
@@ -22,17 +32,483 @@ def prompt(message):
 
 """
 Request helpers
+
+All requests share one session, so connections to a host (e.g. services.gov.im)
+are kept alive and reused rather than paying for a new TCP/TLS handshake each time.
 """
 
+user_agent = 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+
+# (connect, read) timeouts in seconds
+request_timeout = (10, 60)
+
+# number of hosts to keep connection pools for, and connections kept per host
+pool_hosts = 10
+pool_connections_per_host = 8
+
+# retry connection errors and server errors with exponential backoff (1s, 2s, 4s, ...)
+retry_attempts = 3
+retry_backoff = 1.0
+retry_statuses = (429, 500, 502, 503, 504)
+
+session = None
+session_lock = threading.Lock()
+
+# base URL of a local fixture server (see src/fixtures.py) to send all requests through,
+# e.g. http://127.0.0.1:8765 - None requests upstream directly
+fixture_server_url = None
+
+# multiplier for polite pauses between requests, e.g. 0 when replaying fixtures locally
+pause_scale = 1.0
+
+
+def get_session():
+    global session
+
+    with session_lock:
+        if session is None:
+            session = build_session()
+
+    return session
+
+
+def build_session():
+    retry = Retry(
+        total=retry_attempts,
+        backoff_factor=retry_backoff,
+        status_forcelist=retry_statuses,
+        allowed_methods=("GET", "HEAD"),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_hosts,
+        pool_maxsize=pool_connections_per_host,
+        pool_block=True,
+        max_retries=retry
+    )
+
+    s = requests.Session()
+    s.headers.update({'User-Agent': user_agent})
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+
+    return s
+
+
+def get_url(url, timeout=None, headers=None):
+    wait_for_rate_limit(url)
 
-def get_url(url):
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'}
+    r = get_session().get(fixture_url(url), headers=headers, timeout=timeout or request_timeout,
+                          allow_redirects=True)
 
-    r = requests.get(url, headers=headers, allow_redirects=True)
+    count_http_request(len(r.content))
 
     return r
 
 
+def fixture_url(url):
+    """
+    Rewrite an upstream URL to go via the fixture server if one is configured,
+    e.g. https://host/path?q -> http://127.0.0.1:8765/https/host/path?q
+    """
+    if not fixture_server_url:
+        return url
+
+    parts = urllib.parse.urlsplit(url)
+    rewritten = fixture_server_url.rstrip("/") + "/" + parts.scheme + "/" + parts.netloc + parts.path
+    if parts.query:
+        rewritten = rewritten + "?" + parts.query
+
+    return rewritten
+
+
+def pause(seconds):
+    time.sleep(seconds * pause_scale)
+
+
+"""
+Rate limiting helpers
+
+A token bucket per host, shared by every thread making requests through get_url,
+keeps concurrent crawls within an agreed requests-per-second budget for that host.
+"""
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            # pause_scale of 0 (e.g. replaying fixtures) disables the limit
+            if not pause_scale:
+                return
+            time.sleep(wait * pause_scale)
+
+
+def set_rate_limit(host, rate, burst=1):
+    """
+    Limit requests to `host` (e.g. services.gov.im) to `rate` per second, allowing bursts of `burst`.
+    """
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(host)
+        if limiter and limiter.rate == rate and limiter.burst == burst:
+            return
+        rate_limiters[host] = RateLimiter(rate, burst)
+
+
+def wait_for_rate_limit(url):
+    limiter = rate_limiters.get(urllib.parse.urlsplit(url).netloc)
+    if limiter:
+        limiter.acquire()
+
+
+"""
+Instrumentation helpers
+
+Functions decorated with @instrument record wall time, memory (the change in RSS,
+how far the step raised the process's peak RSS, and that peak), rows in and out,
+bytes read and written and HTTP requests made, collected into a run report that
+update.py writes out as JSON. Byte and request counts are process-wide, so they
+include any other stages running at the same time.
+"""
+
+run_report = {
+    "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    "argv": sys.argv,
+    "stages": [],
+    "steps": []
+}
+run_report_lock = threading.Lock()
+
+http_counters = {"requests": 0, "bytes": 0}
+
+
+def count_http_request(nbytes):
+    with run_report_lock:
+        http_counters["requests"] += 1
+        http_counters["bytes"] += nbytes
+
+
+def count_rows(value):
+    """
+    Total rows in a DataFrame, or in any DataFrames nested in dicts/lists. None if there are none.
+    """
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        counts = [c for c in map(count_rows, value) if c is not None]
+        return sum(counts) if counts else None
+
+    return None
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process now (Linux only), or None.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+
+
+def process_peak_rss_mb():
+    """
+    Highest resident set size of this process so far, i.e. over every step run before as well.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+
+    return round(peak / 1024, 1)
+
+
+def process_io():
+    """
+    Bytes read and written by this process so far (Linux only), or None.
+    """
+    try:
+        with open("/proc/self/io") as fp:
+            counters = dict(line.split(": ") for line in fp.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def instrument(func):
+    name = func.__module__.split(".")[-1] + "." + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        rows_in = count_rows([args, kwargs])
+        io_before = process_io()
+        rss_before = current_rss_mb()
+        peak_before = process_peak_rss_mb()
+        with run_report_lock:
+            http_before = dict(http_counters)
+        start = time.perf_counter()
+
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            io_after = process_io()
+            rss_after = current_rss_mb()
+            peak_after = process_peak_rss_mb()
+            with run_report_lock:
+                step = {
+                    "step": name,
+                    "thread": threading.current_thread().name,
+                    "seconds": round(time.perf_counter() - start, 3),
+                    # the process peak covers every earlier step, so also record what this step added:
+                    # the change in RSS, and how far it raised the peak (0 if it stayed under an earlier peak)
+                    "rss_delta_mb": round(rss_after - rss_before, 1)
+                    if rss_before is not None and rss_after is not None else None,
+                    "peak_rss_increase_mb": round(peak_after - peak_before, 1) if peak_before is not None else None,
+                    "process_peak_rss_mb": peak_after,
+                    "rows_in": rows_in,
+                    "rows_out": count_rows(result),
+                    "bytes_read": io_after[0] - io_before[0] if io_before and io_after else None,
+                    "bytes_written": io_after[1] - io_before[1] if io_before and io_after else None,
+                    "http_requests": http_counters["requests"] - http_before["requests"],
+                    "http_bytes": http_counters["bytes"] - http_before["bytes"]
+                }
+                run_report["steps"].append(step)
+
+    return wrapper
+
+
+def record_stage_result(stage, result, seconds):
+    with run_report_lock:
+        run_report["stages"].append({
+            "stage": stage,
+            "result": result,
+            "seconds": round(seconds, 3),
+            "process_peak_rss_mb": process_peak_rss_mb()
+        })
+
+
+def write_run_report(filepath):
+    with run_report_lock:
+        run_report["finished"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        run_report["http"] = dict(http_counters)
+        run_report["process_peak_rss_mb"] = process_peak_rss_mb()
+
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w", encoding="utf-8") as fp:
+            json.dump(run_report, fp, indent=2)
+
+    log("Run report written to", filepath)
+
+
+"""
+Output helpers
+
+CSV outputs can also be written as typed, compressed Parquet files alongside them, so
+downstream reads can load just the columns they need without re-parsing the CSV.
+"""
+
+# write Parquet copies of outputs (set by update.py --parquet)
+parquet_outputs = False
+parquet_compression = "zstd"
+
+
+def parquet_filepath(csv_filepath):
+    return os.path.splitext(csv_filepath)[0] + ".parquet"
+
+
+def write_parquet(df, csv_filepath):
+    """
+    Write a Parquet copy of a CSV output next to it, if Parquet outputs are enabled.
+    """
+    if not parquet_outputs:
+        return
+
+    try:
+        import pyarrow
+    except ImportError:
+        log("    ", "WARNING: pyarrow not installed, skipping Parquet output for", csv_filepath)
+        return
+
+    # object columns can hold mixed values (e.g. numbers and ""), so store them as strings
+    out_df = df.copy()
+    for column in out_df.columns:
+        if out_df[column].dtype == object:
+            out_df[column] = out_df[column].astype("string")
+
+    out_df.to_parquet(parquet_filepath(csv_filepath), index=False, compression=parquet_compression)
+
+
+"""
+HTTP cache helpers
+
+Response bodies for large downloads are stored on disk by URL. Later requests are
+conditional (ETag / If-Modified-Since), so an unchanged upstream file costs a single
+304 round trip. Entries fetched within a source's TTL are used without any request,
+and the least recently used entries are evicted once the cache exceeds its size budget.
+"""
+
+http_cache_dir = ".cache/http/"
+http_cache_max_bytes = 1024 * 1024 * 1024
+
+http_cache_lock = threading.Lock()
+
+
+def get_cached_url(url, ttl=None):
+    """
+    Return the body of `url` as bytes, via the on-disk cache.
+
+    Args:
+        url: URL to retrieve.
+        ttl: Seconds a cached copy may be used without revalidating. None always revalidates.
+
+    Returns:
+        Response body, either freshly downloaded or from the cache if unchanged upstream.
+    """
+    key = sha256(url.encode("utf-8")).hexdigest()
+    body_path = http_cache_dir + key + ".body"
+    meta = read_cache_meta(key) if os.path.isfile(body_path) else None
+
+    headers = {}
+    if meta:
+        if ttl is not None and time.time() - meta["fetched"] < ttl:
+            log("    ", "Using cached copy of", url)
+            return read_cache_body(key, meta)
+
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    r = get_url(url, headers=headers)
+
+    if r.status_code == 304 and meta:
+        log("    ", "Not modified since last download:", url)
+        meta["fetched"] = time.time()
+        return read_cache_body(key, meta)
+
+    if r.status_code != 200:
+        if meta:
+            log("    ", "WARNING: received status", r.status_code, "for", url, "- using cached copy")
+            return read_cache_body(key, meta)
+        r.raise_for_status()
+
+    write_cache_entry(key, url, r)
+
+    return r.content
+
+
+def read_cache_meta(key):
+    try:
+        with open(http_cache_dir + key + ".json", "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def read_cache_body(key, meta):
+    with open(http_cache_dir + key + ".body", "rb") as fp:
+        body = fp.read()
+
+    # record access for LRU eviction
+    meta["accessed"] = time.time()
+    write_cache_meta(key, meta)
+
+    return body
+
+
+def write_cache_meta(key, meta):
+    tmp_path = http_cache_dir + key + ".json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(meta, fp)
+    os.replace(tmp_path, http_cache_dir + key + ".json")
+
+
+def write_cache_entry(key, url, r):
+    with http_cache_lock:
+        os.makedirs(http_cache_dir, exist_ok=True)
+
+        tmp_path = http_cache_dir + key + ".body.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(r.content)
+        os.replace(tmp_path, http_cache_dir + key + ".body")
+
+        now = time.time()
+        write_cache_meta(key, {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "size": len(r.content),
+            "fetched": now,
+            "accessed": now
+        })
+
+        evict_cache(keep=key)
+
+
+def evict_cache(keep=None):
+    """
+    Remove least recently used entries until the cache is within http_cache_max_bytes.
+    """
+    entries = []
+    for filename in os.listdir(http_cache_dir):
+        if filename.endswith(".json"):
+            key = filename[:-len(".json")]
+            meta = read_cache_meta(key)
+            if meta:
+                entries.append((meta["accessed"], meta["size"], key))
+
+    total = sum(size for _, size, _ in entries)
+    for accessed, size, key in sorted(entries):
+        if total <= http_cache_max_bytes:
+            break
+        if key == keep:
+            continue
+
+        log("    ", "Evicting", key, "from HTTP cache")
+        for suffix in (".body", ".json"):
+            if os.path.isfile(http_cache_dir + key + suffix):
+                os.remove(http_cache_dir + key + suffix)
+        total -= size
+
+
 """
 Hashing helpers
 
@@ -65,6 +541,9 @@ def get_md5_series_from_dataframe(input_dataframe: pd.DataFrame,
     """
     Create a Pandas ``Series`` of MD5 hashses for every row in a Pandas ``DataFrame``.
 
+    Row strings are built column by column rather than row by row, giving the same hashes as
+    ``get_md5_from_series`` applied to each row.
+
     Args:
         input_dataframe: Pandas ``DataFrame`` to be create MD5 hashes for.
         columns: If only wanting to use specific columns to calculate the hash, specify these here.
@@ -76,10 +555,29 @@ def get_md5_series_from_dataframe(input_dataframe: pd.DataFrame,
     # if columns specified, filter to just these columns
     in_df = input_dataframe.iloc[:, list(columns)] if columns is not None else input_dataframe
 
+    # rows are formatted from the frame's common dtype (as with apply(axis=1)); datetime64 and
+    # extension dtypes format differently in bulk, so fall back to hashing per row for those
+    values = in_df.to_numpy()
+    bulk_formattable = all(isinstance(dtype, np.dtype) for dtype in in_df.dtypes) and values.dtype.kind in "Oifub"
+    if not bulk_formattable or not len(in_df.columns):
+        return in_df.apply(lambda row: get_md5_from_series(row), axis=1)
+
+    # concatenate string values column-wise
+    row_strings = pd.Series([""] * len(in_df), dtype=object)
+    for i in range(values.shape[1]):
+        row_strings = row_strings + pd.Series(values[:, i], dtype=object).astype(str)
+
     # create md5 hash per row
-    md5_hashes = in_df.apply(lambda row: get_md5_from_series(row), axis=1)
+    md5_hashes = get_md5_list(row_strings)
 
-    return md5_hashes
+    return pd.Series(md5_hashes, index=in_df.index, dtype=object)
+
+
+def get_md5_list(strings: Iterable[str]) -> list:
+    """
+    MD5 hashes of a list of strings, encoded as UTF-8.
+    """
+    return [md5(s.encode('utf-8')).hexdigest() for s in strings]
 
 
 def add_md5_hash_column(input_dataframe: pd.DataFrame, md5_column_name: str = 'md5_hash',
@@ -2,7 +2,8 @@ import os
 import pandas as pd
 import csv
 import json
-from src.helpers import add_md5_hash_column, get_url, log, prompt
+from src.helpers import add_md5_hash_column, get_cached_url, instrument, log, prompt, write_parquet
+from src.manifest import inputs_digest, stage_is_current, record_stage
 
 
 """
@@ -30,16 +31,44 @@ def land_transactions(interactive=True, skip_download=False):
     with open(data_dir + "sources/sources.json") as fp:
         sources = json.load(fp)
 
-    data = load_data(sources, interactive=interactive, skip_download=skip_download)
+    update_source_file(sources, interactive=interactive, skip_download=skip_download)
+
+    # skip processing if the source file, corrections and code are unchanged since the last run
+    digest = inputs_digest([
+        data_dir + "sources/" + source_file,
+        data_dir + "sources/sources.json",
+        data_dir + "sources/corrections/",
+        __file__
+    ])
+    if stage_is_current("land_transactions", digest, outputs=output_files()):
+        log("    ", "Sources unchanged since last run, skipping processing")
+        return
+
+    data = read_source_file()
     data = process_data(data)
     write_data(data)
 
     write_issues()
 
+    record_stage("land_transactions", digest)
+
+
+def output_files():
+    outputs = ["land-transactions.csv", "issues.csv", "issue-rows.csv"]
+    outputs += ["addressing/" + name + ".csv"
+                for name in ["addresses", "localities", "parishes", "postcodes", "streets", "towns"]]
+
+    return [data_dir + "outputs/" + output for output in outputs]
+
 
 def load_data(sources, interactive=True, skip_download=False):
-    log(" - Loading Land Transactions")
+    update_source_file(sources, interactive=interactive, skip_download=skip_download)
 
+    return read_source_file()
+
+
+@instrument
+def update_source_file(sources, interactive=True, skip_download=False):
     source_file_path = data_dir + "sources/" + source_file
 
     # retrieve file and save local copy in source directory
@@ -56,11 +85,18 @@ def load_data(sources, interactive=True, skip_download=False):
         update = not skip_download
 
     if update:
-        r = get_url(sources["url"])
+        content = get_cached_url(sources["url"], ttl=sources.get("cache_ttl"))
 
-        open(source_file_path, 'wb').write(r.content)
+        open(source_file_path, 'wb').write(content)
         log("    ", "Land Transactions retrieved and saved to source directory")
 
+
+@instrument
+def read_source_file():
+    log(" - Loading Land Transactions")
+
+    source_file_path = data_dir + "sources/" + source_file
+
     # read data from local file into dataframe
     data = pd.read_csv(source_file_path)
 
@@ -69,6 +105,7 @@ def load_data(sources, interactive=True, skip_download=False):
     return data
 
 
+@instrument
 def process_data(data):
     log(" - Processing Land Transactions")
 
@@ -80,14 +117,18 @@ def process_data(data):
     return data
 
 
+@instrument
 def write_data(data):
     log(" - Writing Land Transactions")
 
-    data.to_csv(data_dir + 'outputs/land-transactions.csv', index=False, quoting=csv.QUOTE_ALL)
+    filepath = data_dir + 'outputs/land-transactions.csv'
+    data.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+    write_parquet(data, filepath)
 
     log("    ", len(data), "rows written")
 
 
+@instrument
 def write_issues():
     log(" - Writing issues")
 
@@ -0,0 +1,146 @@
+import os
+import json
+import threading
+from hashlib import sha256
+from datetime import datetime
+from src import helpers
+from src.helpers import log
+
+"""
+Build manifest
+
+Records a hash of each stage's inputs (source files, configuration and code) so
+that stages can be skipped when nothing they depend on has changed since the
+last successful run.
+
+"""
+
+manifest_filepath = ".cache/manifest.json"
+
+# code shared by every stage, included in each stage's inputs
+shared_code = ["src/helpers.py", "src/manifest.py"]
+
+# set to True to ignore recorded hashes and rebuild everything
+force = False
+
+lock = threading.Lock()
+
+
+def load_manifest():
+    if os.path.isfile(manifest_filepath):
+        try:
+            with open(manifest_filepath, "r", encoding="utf-8") as fp:
+                return json.load(fp)
+        except Exception as e:
+            log("    ", "WARNING: Could not read build manifest:", e)
+
+    return {"files": {}, "stages": {}}
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(manifest_filepath), exist_ok=True)
+
+    tmp_filepath = manifest_filepath + ".tmp"
+    with open(tmp_filepath, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(tmp_filepath, manifest_filepath)
+
+
+def expand_paths(paths):
+    """
+    Expand directories into the files they contain, sorted so the digest is stable.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                dirs.sort()
+                for filename in sorted(filenames):
+                    files.append(os.path.relpath(os.path.join(root, filename)))
+        else:
+            files.append(os.path.relpath(path))
+
+    return files
+
+
+def file_digest(filepath, file_cache):
+    """
+    Hash a file, reusing the recorded hash if its size and modification time
+    are unchanged so large unchanged sources aren't re-read.
+    """
+    if not os.path.isfile(filepath):
+        return "missing"
+
+    stat = os.stat(filepath)
+    cached = file_cache.get(filepath)
+    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    h = sha256()
+    with open(filepath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    file_cache[filepath] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest
+    }
+
+    return digest
+
+
+def inputs_digest(inputs, config=None):
+    """
+    Combined hash of all input files (and directories) plus the shared code, and
+    any options (`config`, JSON serialisable) that change the stage's outputs.
+    Options shared by every stage (whether Parquet copies are written) are included too.
+    """
+    config = dict(config or {}, parquet=helpers.parquet_outputs)
+
+    with lock:
+        manifest = load_manifest()
+
+        h = sha256()
+        for filepath in expand_paths(list(inputs) + shared_code):
+            h.update(filepath.encode("utf-8"))
+            h.update(file_digest(filepath, manifest["files"]).encode("utf-8"))
+
+        save_manifest(manifest)
+
+    h.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def stage_is_current(stage, digest, outputs=()):
+    """
+    True if the stage last completed with the same inputs digest and all of its
+    outputs still exist.
+    """
+    if force:
+        return False
+
+    with lock:
+        manifest = load_manifest()
+
+    recorded = manifest["stages"].get(stage)
+    if not recorded or recorded["digest"] != digest:
+        return False
+
+    for filepath in outputs:
+        if not os.path.exists(filepath):
+            return False
+
+    return True
+
+
+def record_stage(stage, digest):
+    with lock:
+        manifest = load_manifest()
+        manifest["stages"][stage] = {
+            "digest": digest,
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        save_manifest(manifest)
@@ -0,0 +1,270 @@
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+from bisect import bisect_left
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from src.helpers import log
+
+"""
+Company name index
+
+A persistent index over the current and previous company names in the
+companies-live, companies-non-live and old-names outputs, rebuilt each time
+they are written. Names are normalised (upper case, punctuation removed) and
+indexed two ways:
+
+  * prefix: row ids sorted by normalised name, binary searched for the names
+    starting with the query
+  * trigram: the distinct trigrams of each name (padded with a space at each
+    end, so word boundaries count), stored as a sorted array of trigrams with
+    CSR offsets into an array of row ids
+
+Every array is a .npy file loaded with mmap_mode="r", so opening the index reads
+next to nothing and a query only touches the pages it needs. Results are ranked
+with prefix matches first, then by the share of the query's trigrams found in
+the name, then fewest trigrams not in the query.
+
+    python -m src.name_index "manx trading"
+    python -m src.name_index "manx trad" --limit 5 --min-score 0.8
+
+    index = NameIndex()
+    index.search("manx trading", limit=10)
+
+"""
+
+index_dir = ".cache/name-index/"
+outputs_dir = "data/gov.im/companies/outputs/"
+
+record_columns = ["Name", "Number", "Registry Type", "Status", "Name Status"]
+
+# rows per block when generating trigrams, bounds the size of the intermediate arrays
+trigram_block_rows = 10000
+
+# prefix matches read before ranking, for very short prefixes
+max_prefix_matches = 1000
+
+
+def normalize(name):
+    """
+    Upper case, with runs of anything other than letters and digits replaced by a single space.
+    """
+    return re.sub(r"[\W_]+", " ", str(name).upper()).strip()
+
+
+def trigram_codes(keys):
+    """
+    keys: sequence of normalised names
+    Returns (row, trigram) arrays for every trigram of every key, each trigram packed into a uint64
+    as three 21 bit code points.
+    """
+    padded = np.array([" " + key + " " for key in keys], dtype=str)
+    width = padded.dtype.itemsize // 4
+    chars = padded.view(np.uint32).reshape(len(padded), width).astype(np.uint64)
+
+    codes = (chars[:, :-2] << np.uint64(42)) | (chars[:, 1:-1] << np.uint64(21)) | chars[:, 2:]
+    # shorter names are padded out with zeros in the fixed width array
+    valid = chars[:, 2:] != 0
+    rows = np.broadcast_to(np.arange(len(padded))[:, None], codes.shape)
+
+    return rows[valid], codes[valid]
+
+
+def build_index(frames, path=None):
+    """
+    frames: dataframes with record_columns (the companies-live, companies-non-live and old-names outputs)
+    Writes the index to path (index_dir by default), replacing any previous index once complete.
+    """
+    path = path or index_dir
+
+    records = pd.concat([df[record_columns] for df in frames]).fillna("").astype(str)
+    records = records.drop_duplicates(subset=["Name", "Number", "Registry Type", "Name Status"])
+    keys = [normalize(name) for name in records["Name"]]
+
+    lines = ["\t".join(value.replace("\t", " ") for value in row) for row in records.itertuples(index=False)]
+
+    # distinct (trigram, row) pairs, in trigram then row order
+    rows, codes = [], []
+    for start in range(0, len(keys), trigram_block_rows):
+        block_rows, block_codes = trigram_codes(keys[start:start + trigram_block_rows])
+        rows.append(block_rows + start)
+        codes.append(block_codes)
+    rows = np.concatenate(rows + [np.array([], dtype=int)])
+    codes = np.concatenate(codes + [np.array([], dtype=np.uint64)])
+
+    order = np.lexsort((rows, codes))
+    rows, codes = rows[order], codes[order]
+    distinct = np.ones(len(codes), dtype=bool)
+    distinct[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+    rows, codes = rows[distinct], codes[distinct]
+
+    trigrams, starts = np.unique(codes, return_index=True)
+
+    arrays = {
+        "records": blob(lines),
+        "record_offsets": offsets(lines),
+        "keys": blob(keys),
+        "key_offsets": offsets(keys),
+        "prefix_order": np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int32),
+        "trigrams": trigrams,
+        "trigram_offsets": np.append(starts, len(codes)).astype(np.int64),
+        "postings": rows.astype(np.int32),
+        "trigram_counts": np.bincount(rows, minlength=len(keys)).astype(np.int32)
+    }
+
+    # build alongside, then swap in, so a query never sees a partly written index
+    tmp_path = path.rstrip("/") + ".tmp"
+    old_path = path.rstrip("/") + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fp:
+        json.dump({"built": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "names": len(keys),
+                   "trigrams": len(trigrams)}, fp)
+
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    log("    ", "Name index built:", len(keys), "names,", len(trigrams), "trigrams")
+
+
+def build_from_outputs(path=None):
+    frames = [pd.read_csv(outputs_dir + output + ".csv", usecols=record_columns, dtype=str, keep_default_na=False)
+              for output in ("companies-live", "companies-non-live", "old-names")]
+    build_index(frames, path)
+
+
+def blob(strings):
+    return np.frombuffer("".join(strings).encode("utf-8"), dtype=np.uint8)
+
+
+def offsets(strings):
+    lengths = [len(string.encode("utf-8")) for string in strings]
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+
+class SortedKeys:
+    """
+    The normalised names in prefix order, as a sequence for bisect.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index.prefix_order)
+
+    def __getitem__(self, position):
+        return self.index.key(self.index.prefix_order[position])
+
+
+class NameIndex:
+    def __init__(self, path=None):
+        path = path or index_dir
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            raise FileNotFoundError("No name index in " + path + ", run the companies update or --build")
+
+        for name in ("records", "record_offsets", "keys", "key_offsets", "prefix_order", "trigrams",
+                     "trigram_offsets", "postings", "trigram_counts"):
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.key_offsets) - 1
+
+    def key(self, row):
+        return bytes(self.keys[self.key_offsets[row]:self.key_offsets[row + 1]]).decode("utf-8")
+
+    def record(self, row):
+        line = bytes(self.records[self.record_offsets[row]:self.record_offsets[row + 1]]).decode("utf-8")
+        return dict(zip(record_columns, line.split("\t")))
+
+    def prefix_matches(self, key):
+        """
+        Rows whose normalised name starts with key, up to max_prefix_matches.
+        """
+        keys = SortedKeys(self)
+        position = bisect_left(keys, key)
+
+        rows = []
+        while position < len(keys) and len(rows) < max_prefix_matches and keys[position].startswith(key):
+            rows.append(int(self.prefix_order[position]))
+            position += 1
+
+        return rows
+
+    def trigram_matches(self, key):
+        """
+        (rows, scores) of the names sharing any trigram with key, scored by the share of key's trigrams they contain.
+        """
+        _, codes = trigram_codes([key])
+        codes = np.unique(codes)
+
+        positions = np.searchsorted(self.trigrams, codes)
+        found = positions < len(self.trigrams)
+        found[found] = self.trigrams[positions[found]] == codes[found]
+
+        postings = [self.postings[self.trigram_offsets[p]:self.trigram_offsets[p + 1]] for p in positions[found]]
+        if not postings:
+            return np.array([], dtype=np.int32), np.array([])
+
+        rows, shared = np.unique(np.concatenate(postings), return_counts=True)
+        return rows, shared / len(codes)
+
+    def search(self, query, limit=20, min_score=0.5):
+        """
+        Companies whose current or previous name best matches query, as dicts of record_columns
+        plus Score (1.0 for a prefix match, otherwise the share of the query's trigrams in the name).
+        """
+        key = normalize(query)
+        if not key:
+            return []
+
+        scores = {}
+        rows, trigram_scores = self.trigram_matches(key)
+        keep = trigram_scores >= min_score
+        for row, score in zip(rows[keep].tolist(), trigram_scores[keep].tolist()):
+            scores[row] = (False, score)
+        for row in self.prefix_matches(key):
+            scores[row] = (True, 1.0)
+
+        # ties go to the names with the fewest trigrams the query doesn't have
+        counts = {row: int(self.trigram_counts[row]) for row in scores}
+        ranked = sorted(scores, key=lambda row: (not scores[row][0], -scores[row][1], counts[row], row))
+
+        return [dict(self.record(row), Score=round(scores[row][1], 3)) for row in ranked[:limit]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search current and previous company names")
+    parser.add_argument("query", nargs="?", help="Name, or part of a name, to search for")
+    parser.add_argument("--limit", type=int, default=20, help="Maximum results (default 20)")
+    parser.add_argument("--min-score", type=float, default=0.5,
+                        help="Minimum share of the query's trigrams a name must contain (default 0.5)")
+    parser.add_argument("--index", default=index_dir, help="Index directory")
+    parser.add_argument("--build", action="store_true", help="Rebuild the index from the companies outputs first")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    if args.build:
+        build_from_outputs(args.index)
+    if not args.query:
+        sys.exit(0)
+
+    started = datetime.now()
+    results = NameIndex(args.index).search(args.query, args.limit, args.min_score)
+    elapsed = (datetime.now() - started).total_seconds()
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+        else:
+            print(f"{result['Score']:.2f}  {result['Number']:<8} {result['Name']:<60} {result['Status']:<16} "
+                  f"{result['Registry Type']} ({result['Name Status'].lower()} name)")
+    print(len(results), "results in", f"{elapsed * 1000:.1f}ms", file=sys.stderr)
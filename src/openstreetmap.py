@@ -1,14 +1,9 @@
 import os
 import pandas as pd
-import geopandas
-from shapely.geometry import shape
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.point import Point
-from shapely import get_x, get_y
-import overpass
 import csv
 import json
-from src.helpers import log, prompt
+from src.helpers import count_http_request, fixture_url, instrument, log, prompt, write_parquet
+from src.manifest import inputs_digest, stage_is_current, record_stage
 
 """
 OpenStreetMap data processing
@@ -19,6 +14,7 @@ data_dir = "data/openstreetmap/"
 github_url = "https://github.com/dankarran/isleofman-opendata"
 github_project = "dankarran/isleofman-opendata"
 im_postcode_regex = '^IM[0-9] [0-9][A-Z]{2}$'
+overpass_endpoint = "https://overpass-api.de/api/interpreter"
 
 
 def openstreetmap(interactive=True):
@@ -27,18 +23,43 @@ def openstreetmap(interactive=True):
     with open(data_dir + "sources/sources.json") as fp:
         sources = json.load(fp)
 
-    data = load_data(sources, interactive)
+    download_data(sources, interactive)
+
+    # skip processing if the downloaded data and code are unchanged since the last run
+    digest = inputs_digest([
+        data_dir + "sources/overpass/",
+        data_dir + "sources/sources.json",
+        __file__
+    ])
+    if stage_is_current("openstreetmap", digest, outputs=output_files(sources)):
+        log("    ", "Sources unchanged since last run, skipping processing")
+        return
+
+    data = read_data(sources)
     data = process_data(sources, data)
     write_data(sources, data)
 
+    record_stage("openstreetmap", digest)
+
+
+def output_files(sources):
+    outputs = []
+    for source in sources["overpass"]:
+        filepath_base = data_dir + "outputs/" + source["label"] + "/" + source["label"]
+        for output_format in ["geojson", "csv"]:
+            if output_format in source["output_formats"]:
+                outputs.append(filepath_base + "." + output_format)
+
+    return outputs
+
 
 def load_data(sources, interactive=True):
-    log(" - Loading data")
+    download_data(sources, interactive)
+
+    return read_data(sources)
 
-    data = {
-        "overpass": {}
-    }
 
+def download_data(sources, interactive=True):
     if interactive:
         update_text = prompt("Download updated OpenStreetMap data? (y/N) ")
         if update_text == "y":
@@ -46,6 +67,15 @@ def load_data(sources, interactive=True):
     else:
         update_files(sources)
 
+
+@instrument
+def read_data(sources):
+    log(" - Loading data")
+
+    data = {
+        "overpass": {}
+    }
+
     for source in sources["overpass"]:
         filepath = data_dir + "sources/overpass/" + source["label"] + ".geojson"
         if os.path.isfile(filepath):
@@ -60,6 +90,7 @@ def load_data(sources, interactive=True):
     return data
 
 
+@instrument
 def update_files(sources):
     for source in sources["overpass"]:
 
@@ -77,18 +108,29 @@ def update_files(sources):
 
 
 def get_overpass(query, response_format="geojson", verbosity="geom"):
+    import overpass
+
     log("    ", "Querying Overpass API for", query, "in", response_format, "format with verbosity", verbosity)
-    api = overpass.API(user_agent="Isle of Man Open Data")
+    api = overpass.API(endpoint=fixture_url(overpass_endpoint), user_agent="Isle of Man Open Data")
     result = api.get(
         query,
         responseformat=response_format,
         verbosity=verbosity
     )
 
+    # the overpass client doesn't expose the response size
+    count_http_request(0)
+
     return result
 
 
+@instrument
 def process_data(sources, data):
+    from shapely.geometry import shape
+    from shapely.geometry.polygon import Polygon
+    from shapely.geometry.point import Point
+    from shapely import get_x, get_y
+
     log(" - Processing OpenStreetMap data")
 
     for source in sources["overpass"]:
@@ -128,6 +170,7 @@ def process_data(sources, data):
     return data
 
 
+@instrument
 def write_data(sources, data):
     log(" - Writing OpenStreetMap data")
 
@@ -171,8 +214,10 @@ def write_data(sources, data):
                     df_out = df_out.sort_values(by=source["sort_columns"])
 
                 df_out.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+                write_parquet(df_out, filepath)
 
 
+@instrument
 def generate_postcode_boundaries(interactive=True):
     run_update = False
     if interactive:
@@ -185,6 +230,21 @@ def generate_postcode_boundaries(interactive=True):
     if not run_update:
         return
 
+    import geopandas
+
+    # skip if the postcode data, corrections and code are unchanged since the last run
+    digest = inputs_digest([
+        data_dir + "sources/overpass/postcodes.geojson",
+        data_dir + "sources/overpass/postal_codes.geojson",
+        data_dir + "sources/corrections/non-geographic-postcodes.csv",
+        __file__
+    ])
+    outputs = [data_dir + "outputs/postcodes/postcode_" + plural + ".geojson"
+               for plural in ["districts", "sectors", "sector_alphas", "areas"]]
+    if stage_is_current("generate_postcode_boundaries", digest, outputs=outputs):
+        log("    ", "Sources unchanged since last run, skipping postcode boundaries")
+        return
+
     gdf = None
 
     # addr:postcode entries (used in addresses)
@@ -242,6 +302,8 @@ def generate_postcode_boundaries(interactive=True):
 
         log("    ", len(convex_hull), plural, "added")
 
+    record_stage("generate_postcode_boundaries", digest)
+
 
 def print_datasets_markdown(interactive=True):
     run_update = False
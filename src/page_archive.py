@@ -0,0 +1,97 @@
+import os
+import gzip
+import json
+import threading
+from hashlib import sha256
+from datetime import datetime
+
+"""
+Page archive
+
+Raw response bodies of fetched registry pages, kept so the parsers can be
+re-run over them without crawling again. Bodies are stored gzipped under
+their sha256, so an unchanged page fetched twice is stored once, and
+index.jsonl records each fetch:
+
+    {"kind": "details", "key": "000123C", "url": ..., "fetched": "2025-01-01 12:00:00",
+     "status": 200, "encoding": "utf-8", "sha256": ...}
+
+"""
+
+archive_dir = ".cache/pages/"
+
+lock = threading.Lock()
+
+
+def body_filepath(digest):
+    return os.path.join(archive_dir, "objects", digest[:2], digest + ".gz")
+
+
+def index_filepath():
+    return os.path.join(archive_dir, "index.jsonl")
+
+
+def archive_page(kind, key, url, status, content, encoding=None):
+    """
+    Store a fetched page body and record the fetch in the index. Returns the body's sha256.
+    """
+    digest = sha256(content).hexdigest()
+
+    filepath = body_filepath(digest)
+    if not os.path.isfile(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # write then rename, so a concurrent or interrupted write never leaves a partial body
+        tmp_filepath = filepath + "." + str(threading.get_ident()) + ".tmp"
+        with open(tmp_filepath, "wb") as fp:
+            fp.write(gzip.compress(content))
+        os.replace(tmp_filepath, filepath)
+
+    entry = {
+        "kind": kind,
+        "key": key,
+        "url": url,
+        "fetched": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": status,
+        "encoding": encoding,
+        "sha256": digest
+    }
+
+    with lock:
+        with open(index_filepath(), "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    return digest
+
+
+def read_page(entry):
+    """
+    Body of an archived page, decoded with the encoding it was fetched with if known.
+    """
+    with open(body_filepath(entry["sha256"]), "rb") as fp:
+        content = gzip.decompress(fp.read())
+
+    if entry.get("encoding"):
+        return content.decode(entry["encoding"], errors="replace")
+
+    return content
+
+
+def latest_pages(kind):
+    """
+    The most recent index entry for each key of the given kind.
+    """
+    latest = {}
+    if not os.path.isfile(index_filepath()):
+        return latest
+
+    with open(index_filepath(), "r", encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # last line of an interrupted run
+                continue
+            if entry["kind"] == kind:
+                latest[entry["key"]] = entry
+
+    return latest
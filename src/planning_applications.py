@@ -1,10 +1,10 @@
 import os
 import io
-import time
 import pandas as pd
 import csv
 import json
-from src.helpers import get_url, log, prompt
+from src.helpers import get_cached_url, get_url, instrument, log, pause, prompt, write_parquet
+from src.manifest import inputs_digest, stage_is_current, record_stage
 
 """
 Planning Applications data processing
@@ -44,13 +44,38 @@ def planning_applications(interactive=True, update_weekly=False, update_annual=F
                 update_annual_files(sources[record_type]["annual"], record_type, interactive)
 
     if process:
+        # skip processing if the source files, configuration and code are unchanged since the last run
+        digest = inputs_digest([
+            data_dir + "sources/weekly/",
+            data_dir + "sources/annual/",
+            data_dir + "sources/sources.json",
+            data_dir + "sources/defaults.json",
+            __file__
+        ])
+        if stage_is_current("planning_applications", digest, outputs=output_files(sources)):
+            log("    ", "Sources unchanged since last run, skipping processing")
+            return
+
         with open(data_dir + "sources/defaults.json") as fp:
             default_options = json.load(fp)
         data = load_data(sources, default_options, interactive)
         data = process_data(data)
         write_data(data)
 
+        record_stage("planning_applications", digest)
+
+
+def output_files(sources):
+    outputs = [data_dir + "outputs/addressing/postcodes.csv"]
+    for record_type in record_types:
+        if "weekly" in sources[record_type]:
+            outputs.append(data_dir + "outputs/" + record_type + "-weekly.csv")
+        outputs.append(data_dir + "outputs/" + record_type + ".csv")
+
+    return outputs
+
 
+@instrument
 def load_data(sources, default_options, interactive=True):
     log(" - Loading Planning Applications")
 
@@ -77,6 +102,7 @@ def load_data(sources, default_options, interactive=True):
     return data
 
 
+@instrument
 def update_weekly_files(sources, record_type, interactive=True):
     pub_count = 0
     for pub_date in sources:
@@ -127,7 +153,7 @@ def update_weekly_files(sources, record_type, interactive=True):
                 break
 
             page = page + 1
-            time.sleep(1)
+            pause(1)
 
         # write to CSV file
         if not os.path.isdir(year_dir):
@@ -137,6 +163,7 @@ def update_weekly_files(sources, record_type, interactive=True):
         pub_rows_df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
 
 
+@instrument
 def update_annual_files(sources, record_type, interactive=True):
     for year in sources:
         year_source = sources[year]
@@ -155,8 +182,8 @@ def update_annual_files(sources, record_type, interactive=True):
 
         log("    ", "Downloading", record_type, "for", year)
 
-        r = get_url(year_source["url"])
-        open(filepath, 'wb').write(r.content)
+        content = get_cached_url(year_source["url"], ttl=year_source.get("cache_ttl"))
+        open(filepath, 'wb').write(content)
 
         # drop columns where appropriate (e.g. personal data)
         if "columns_drop" in year_source:
@@ -261,6 +288,7 @@ def read_annual_files(sources, default_options, record_type, data):
     return data
 
 
+@instrument
 def process_data(data):
     log(" - Processing Planning Applications")
 
@@ -307,6 +335,7 @@ def process_addresses(data):
     return data
 
 
+@instrument
 def write_data(data):
     log(" - Writing Planning Applications")
 
@@ -315,10 +344,12 @@ def write_data(data):
             filename = record_type + "-weekly.csv"
             filepath = data_dir + "outputs/" + filename
             data[record_type]["weekly"].to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+            write_parquet(data[record_type]["weekly"], filepath)
             log("    ", len(data[record_type]["weekly"]), record_type, "rows written to", filename)
 
         filename = record_type + ".csv"
         filepath = data_dir + "outputs/" + filename
         data[record_type]["annual"].to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+        write_parquet(data[record_type]["annual"], filepath)
         log("    ", len(data[record_type]["annual"]), record_type, "rows written to", filename)
 
@@ -0,0 +1,121 @@
+import time
+import importlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from src.helpers import log, record_stage_result
+
+"""
+Stage scheduler
+
+Runs update stages as a dependency graph, starting each stage as soon as the
+stages it depends on have finished, with at most `jobs` stages running at once.
+
+"""
+
+
+def stage(name, func, depends=(), **kwargs):
+    """
+    Declare a stage. `func` is called with `kwargs` once every stage named in
+    `depends` has completed. Dependencies on stages that are not part of the
+    current run are ignored.
+
+    `func` may be given as a "module:function" string, which is only imported
+    when the stage runs, so unselected stages don't load their dependencies.
+    """
+    return {
+        "name": name,
+        "func": func,
+        "kwargs": kwargs,
+        "depends": list(depends)
+    }
+
+
+def run_stages(stages, jobs=1):
+    """
+    Run a list of stages, respecting declared dependencies.
+
+    Stages are started in the order given whenever their dependencies allow, so
+    with jobs=1 the run is the same as calling each stage in turn. If a stage
+    fails, any stages depending on it are skipped; independent stages still run.
+
+    Returns a dict mapping stage name to "done", "failed" or "skipped".
+    """
+    names = [s["name"] for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate stage names: " + ", ".join(names))
+
+    # only keep dependencies on stages selected for this run
+    depends = {s["name"]: [d for d in s["depends"] if d in names] for s in stages}
+    check_acyclic(depends)
+
+    results = {}
+    pending = list(stages)
+    running = {}
+    started = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while pending or running:
+            # skip anything whose dependencies failed or were skipped
+            for s in list(pending):
+                if any(results.get(d) in ("failed", "skipped") for d in depends[s["name"]]):
+                    log("    ", "Skipping stage", s["name"], "as a dependency did not complete")
+                    results[s["name"]] = "skipped"
+                    record_stage_result(s["name"], "skipped", 0)
+                    pending.remove(s)
+
+            # start ready stages, up to the jobs limit
+            for s in list(pending):
+                if len(running) >= max(1, jobs):
+                    break
+                if all(results.get(d) == "done" for d in depends[s["name"]]):
+                    log("Starting stage", s["name"])
+                    future = executor.submit(call_stage, s["func"], s["kwargs"])
+                    running[future] = s["name"]
+                    started[s["name"]] = time.perf_counter()
+                    pending.remove(s)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    log("ERROR: Stage", name, "failed:", repr(error))
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    results[name] = "failed"
+                else:
+                    log("Finished stage", name)
+                    results[name] = "done"
+                record_stage_result(name, results[name], time.perf_counter() - started[name])
+
+    return results
+
+
+def call_stage(func, kwargs):
+    # import in the worker, so an import error fails only this stage
+    if isinstance(func, str):
+        module_name, func_name = func.split(":")
+        func = getattr(importlib.import_module(module_name), func_name)
+
+    return func(**kwargs)
+
+
+def check_acyclic(depends):
+    visiting = set()
+    visited = set()
+
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError("Stage dependency cycle: " + " -> ".join(path + [name]))
+        visiting.add(name)
+        for dep in depends[name]:
+            visit(dep, path + [name])
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in depends:
+        visit(name, [])
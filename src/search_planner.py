@@ -0,0 +1,105 @@
+import os
+import pandas as pd
+from src.helpers import log
+
+"""
+Search term coverage planner
+
+The name search terms overlap (a company called "Manx Trading Limited" is found
+by L, A and I alike), so most rows downloaded for a term are companies another
+term already found. Using the stored search results, the planner estimates how
+many requests each term takes and how many companies only it finds, over the
+companies incorporated in a recent window (those a crawl of the latest pages
+would return), then orders the terms greedily by new companies per request.
+
+Terms whose estimated yield falls below a threshold can be skipped, and the
+report shows the requests that would save.
+
+"""
+
+rows_per_page = 30
+
+
+def load_term_numbers(filepaths, window_days=365):
+    """
+    filepaths: dict of term -> search results CSV
+    Returns dict of term -> set of company numbers incorporated in the last `window_days` days (all if None),
+    for the terms whose results are stored.
+    """
+    term_numbers = {}
+    for term, filepath in filepaths.items():
+        if not os.path.isfile(filepath):
+            continue
+
+        data = pd.read_csv(filepath, usecols=["Number", "Inc/Reg Date"], dtype=str)
+        if window_days is not None:
+            incorporated = pd.to_datetime(data["Inc/Reg Date"], format="%d %b %Y", errors="coerce")
+            data = data[incorporated >= pd.Timestamp.now() - pd.Timedelta(days=window_days)]
+
+        term_numbers[term] = set(data["Number"].dropna())
+
+    return term_numbers
+
+
+def plan_terms(term_numbers):
+    """
+    Greedy coverage: repeatedly pick the term with the most companies not found by the terms already picked,
+    per request. Returns a list of dicts in that order, one per term.
+    """
+    remaining = dict(term_numbers)
+    covered = set()
+    total = len(set().union(*term_numbers.values())) if term_numbers else 0
+
+    plan = []
+    while remaining:
+        def yield_per_request(term):
+            pages = max(1, -(-len(remaining[term]) // rows_per_page))
+            return len(remaining[term] - covered) / pages
+
+        term = max(remaining, key=yield_per_request)
+        numbers = remaining.pop(term)
+        new_numbers = numbers - covered
+        covered |= new_numbers
+
+        pages = -(-len(numbers) // rows_per_page)
+        plan.append({
+            "term": term,
+            "requests": pages,
+            "companies": len(numbers),
+            "new_companies": len(new_numbers),
+            "new_per_request": round(len(new_numbers) / pages, 2) if pages else 0.0,
+            "coverage": round(len(covered) / total, 4) if total else 1.0
+        })
+
+    return plan
+
+
+def skipped_terms(plan, min_yield):
+    """
+    Terms whose estimated new companies per request is below min_yield.
+    """
+    return [step["term"] for step in plan if step["new_per_request"] < min_yield]
+
+
+def log_plan(plan, min_yield=0.0, window_days=365):
+    requests = sum(step["requests"] for step in plan)
+    skipped = skipped_terms(plan, min_yield)
+    saved = sum(step["requests"] for step in plan if step["term"] in skipped)
+    missed = sum(step["new_companies"] for step in plan if step["term"] in skipped)
+
+    if window_days is not None:
+        log("    ", "Search term coverage, companies incorporated in the last", window_days, "days:")
+    else:
+        log("    ", "Search term coverage, all stored companies:")
+    log("    ", f"{'term':<12} {'requests':>9} {'companies':>10} {'new':>8} {'new/request':>12} {'coverage':>9}")
+    for step in plan:
+        log("    ", f"{step['term']:<12} {step['requests']:>9} {step['companies']:>10} {step['new_companies']:>8} "
+                   f"{step['new_per_request']:>12.2f} {step['coverage']:>9.1%}" +
+                   ("  skip" if step["term"] in skipped else ""))
+
+    companies = sum(step["companies"] for step in plan)
+    unique = sum(step["new_companies"] for step in plan)
+    log("    ", companies, "companies downloaded for", unique, "distinct companies over", requests, "requests")
+    if min_yield:
+        log("    ", f"Skipping terms under {min_yield} new companies per request would save {saved} of {requests}",
+            f"requests ({saved / requests if requests else 0:.0%}), missing an estimated {missed} companies")
@@ -1,11 +1,11 @@
 import argparse
+import sys
+from datetime import datetime
 
-from src.companies import companies, companies_unindexed, update_company_details
-from src.land_transactions import land_transactions
-from src.planning_applications import planning_applications
-from src.openstreetmap import openstreetmap, generate_postcode_boundaries, print_datasets_markdown
-from src.global_ml_building_footprints import global_ml_building_footprints
-from src.helpers import log
+from src import helpers
+from src.helpers import log, write_run_report
+from src.scheduler import stage, run_stages
+from src import manifest
 
 """
 Isle of Man opendata transformation script
@@ -29,14 +29,32 @@ if __name__ == '__main__':
                         help='Fetch company details for all non-live companies')
     parser.add_argument('--companies-details-new', action='store_true',
                         help='Fetch company details for any new companies not previously fetched')
+    parser.add_argument('--companies-details-stale', action='store_true',
+                        help='Refresh the company details most in need of it, up to --companies-details-max '
+                             '(500 if not given)')
     parser.add_argument('--companies-details-max', type=int, default=None,
                         help='Maximum number of company details requests to perform (None = all)')
-    parser.add_argument('--companies-details-min-sleep', type=float, default=1.0,
-                        help='Minimum sleep between company details requests (seconds)')
-    parser.add_argument('--companies-details-max-sleep', type=float, default=3.0,
-                        help='Maximum sleep between company details requests (seconds)')
+    parser.add_argument('--companies-details-rate', type=float, default=0.5,
+                        help='Maximum company details requests per second, across all workers')
+    parser.add_argument('--companies-details-workers', type=int, default=4,
+                        help='Number of company details pages fetched concurrently')
     parser.add_argument('--companies-details-force', action='store_true',
                         help='Force re-checking details for companies already fetched')
+    parser.add_argument('--companies-search-workers', type=int, default=4,
+                        help='Number of name search terms, or unindexed numbers, searched concurrently')
+    parser.add_argument('--companies-search-rate', type=float, default=0.2,
+                        help='Maximum name/number search requests per second, across all workers')
+    parser.add_argument('--companies-search-min-yield', type=float, default=0.0,
+                        help='Skip name search terms estimated to find fewer new companies than this per request')
+    parser.add_argument('--companies-search-plan', action='store_true',
+                        help='Report estimated requests and new companies per name search term (no requests)')
+    parser.add_argument('--companies-full-list', action='store_true',
+                        help='Also write company-numbers-full.csv, every number up to each registry\'s latest')
+    parser.add_argument('--companies-detail-columns', nargs='+', default=[],
+                        choices=['agent', 'document_count', 'previous_names'],
+                        help='Extra details to add as columns to the company live/non-live outputs')
+    parser.add_argument('--companies-reparse', action='store_true',
+                        help='Rebuild company details from archived pages with the current parsers (no requests)')
 
     parser.add_argument('--land-transactions', action='store_true', help='Run the Land Transactions update')
     parser.add_argument('--land-transactions-skip-download', action='store_true',
@@ -60,27 +78,85 @@ if __name__ == '__main__':
         help='Run the Global ML Building Footprints update'
     )
 
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Maximum number of independent stages to run at the same time')
+
+    parser.add_argument('--force-rebuild', action='store_true',
+                        help='Reprocess every stage even if its inputs are unchanged since the last run')
+
+    parser.add_argument('--fixture-server', default=None,
+                        help='Send all HTTP requests via a fixture server (see src/fixtures.py), e.g. http://127.0.0.1:8765')
+
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also write typed, compressed Parquet copies of CSV outputs')
+
+    parser.add_argument('--report', default=None,
+                        help='Path for the JSON run report (default logs/run-<timestamp>.json)')
+
     args = parser.parse_args()
 
     # Determine if any specific argument was provided.
     # If no specific argument is provided, `run_all` will be True, and we run everything in interactive mode.
     # If any specific argument is provided, `run_all` will be False, and we run only the specified tasks in non-interactive mode.
-    run_all = not any(vars(args).values())
+    config_args = ('jobs', 'force_rebuild', 'fixture_server', 'report', 'parquet', 'companies_full_list', 'companies_detail_columns',
+                   'companies_search_min_yield', 'companies_search_rate', 'companies_search_workers', 'companies_details_rate',
+                   'companies_details_workers')
+    # options with non-empty defaults (e.g. request rates) count as provided only if changed from their default
+    selected = {k: v for k, v in vars(args).items() if k not in config_args and v != parser.get_default(k)}
+    run_all = not selected
     interactive = run_all
 
+    manifest.force = args.force_rebuild
+    helpers.fixture_server_url = args.fixture_server
+    helpers.parquet_outputs = args.parquet
+
+    jobs = args.jobs
+    if interactive and jobs > 1:
+        log('Interactive mode prompts for each dataset, so running stages one at a time')
+        jobs = 1
+
+    # Build stage graph. Dependencies are only enforced between stages selected for this run.
+    # Stage functions are named as strings so each dataset module (and its heavy dependencies,
+    # e.g. geopandas) is only imported if that stage runs.
+    stages = []
+
+    # Companies details re-parsed from archived pages, before the outputs that include them are written
+    if args.companies_reparse:
+        stages.append(stage(
+            'companies_reparse',
+            'src.companies:reparse_company_details'
+        ))
+
+    # Companies name search coverage report
+    if args.companies_search_plan:
+        stages.append(stage(
+            'companies_search_plan',
+            'src.companies:companies_search_plan',
+            min_yield=args.companies_search_min_yield
+        ))
+
     # Companies Registry
     if args.companies_latest or args.companies_unindexed or args.companies_latest_details or run_all:
-        log('Updating Companies Registry data...')
-        companies(
+        stages.append(stage(
+            'companies',
+            'src.companies:companies',
+            depends=['companies_reparse'],
             latest=args.companies_latest,
             unindexed=args.companies_unindexed,
             details=args.companies_latest_details,
+            full_list=args.companies_full_list,
+            detail_columns=args.companies_detail_columns,
+            search_workers=args.companies_search_workers,
+            search_rate=args.companies_search_rate,
+            search_min_yield=args.companies_search_min_yield,
+            details_rate=args.companies_details_rate,
+            details_workers=args.companies_details_workers,
             interactive=interactive
-        )
+        ))
 
     # Companies details retrieval (can be combined). We call the helper with flags.
-    if args.companies_details_live or args.companies_details_non_live or args.companies_details_new:
-        log('Fetching Companies Registry details...')
+    if args.companies_details_live or args.companies_details_non_live or args.companies_details_new or \
+            args.companies_details_stale:
         # choose target based on args; allow multiple targets by passing list
         targets = []
         if args.companies_details_live:
@@ -89,52 +165,97 @@ if __name__ == '__main__':
             targets.append('non-live')
         if args.companies_details_new:
             targets.append('new')
+        if args.companies_details_stale:
+            targets.append('stale')
 
-        # call function to perform requests
-        # update_company_details accepts a list of targets and other options
-        update_company_details(
+        # details are looked up from the companies outputs, so wait for those, and for any re-parse writing to the
+        # same details store
+        stages.append(stage(
+            'companies_details',
+            'src.companies:update_company_details',
+            depends=['companies', 'companies_reparse'],
             targets=targets,
             max_requests=args.companies_details_max,
-            min_sleep=args.companies_details_min_sleep,
-            max_sleep=args.companies_details_max_sleep,
+            rate=args.companies_details_rate,
+            workers=args.companies_details_workers,
             force=args.companies_details_force,
             interactive=interactive
-        )
+        ))
 
     # Land Transactions
     if args.land_transactions or run_all:
-        log('Updating Land Transactions data...')
-        land_transactions(interactive=interactive, skip_download=args.land_transactions_skip_download)
+        stages.append(stage(
+            'land_transactions',
+            'src.land_transactions:land_transactions',
+            interactive=interactive,
+            skip_download=args.land_transactions_skip_download
+        ))
 
     # Planning Applications
     if args.planning_applications or run_all:
-        log('Updating Planning Applications data...')
-        planning_applications(interactive=interactive, update_weekly=True, update_annual=True, process=True)
+        stages.append(stage(
+            'planning_applications',
+            'src.planning_applications:planning_applications',
+            interactive=interactive,
+            update_weekly=True,
+            update_annual=True,
+            process=True
+        ))
 
     if args.update_weekly_planning:
-        log('Updating weekly planning application files...')
-        planning_applications(interactive=interactive, update_weekly=True)
+        stages.append(stage(
+            'update_weekly_planning',
+            'src.planning_applications:planning_applications',
+            depends=['planning_applications'],
+            interactive=interactive,
+            update_weekly=True
+        ))
 
     if args.update_annual_planning:
-        log('Updating annual planning application files...')
-        planning_applications(interactive=interactive, update_annual=True)
+        stages.append(stage(
+            'update_annual_planning',
+            'src.planning_applications:planning_applications',
+            depends=['planning_applications'],
+            interactive=interactive,
+            update_annual=True
+        ))
 
     # OpenStreetMap
     if args.openstreetmap or run_all:
-        log('Updating OpenStreetMap data...')
-        openstreetmap(interactive=interactive)
+        stages.append(stage('openstreetmap', 'src.openstreetmap:openstreetmap', interactive=interactive))
 
     if args.generate_postcode_boundaries or run_all:
-        log('Generating postcode boundaries...')
-        generate_postcode_boundaries(interactive=interactive)
+        stages.append(stage(
+            'generate_postcode_boundaries',
+            'src.openstreetmap:generate_postcode_boundaries',
+            depends=['openstreetmap'],
+            interactive=interactive
+        ))
 
     if args.openstreetmap_markdown or run_all:
-        log('Generating OpenStreetMap markdown...')
-        print_datasets_markdown(interactive=interactive)
+        stages.append(stage(
+            'openstreetmap_markdown',
+            'src.openstreetmap:print_datasets_markdown',
+            depends=['openstreetmap', 'generate_postcode_boundaries'],
+            interactive=interactive
+        ))
 
     # Global ML Building Footprints
     if args.global_ml_building_footprints or run_all:
-        log('Updating Global ML Building Footprints data...')
-        global_ml_building_footprints(interactive=interactive)
+        stages.append(stage(
+            'global_ml_building_footprints',
+            'src.global_ml_building_footprints:global_ml_building_footprints',
+            interactive=interactive
+        ))
+
+    results = run_stages(stages, jobs=jobs)
+
+    report_filepath = args.report or 'logs/run-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.json'
+    write_run_report(report_filepath)
+
+    failed = [name for name, result in results.items() if result != 'done']
+    if failed:
+        log('Update finished with incomplete stages:', ', '.join(failed))
+        sys.exit(1)
 
     log('Update complete.')